@@ -42,6 +42,7 @@ setup(
     install_requires=[
         "wheel",
         "pkginfo>=1.9.6,<2",
+        "packaging",
     ],
     extras_require={
         'dist': ['distro>=1.7.0'],
@@ -16,11 +16,16 @@
 import os
 import sys
 import json
+import time
 import shutil
 import tarfile
+import zipfile
+import pathlib
 import tempfile
+import functools
+import threading
 import subprocess
-import distutils.spawn  # NOQA
+import http.server
 from contextlib import closing
 
 import mock
@@ -34,44 +39,194 @@ TEST_PACKAGE_NAME = 'Flask'
 TEST_PACKAGE_VERSION = '0.10.1'
 TEST_PACKAGE_PLATFORM = 'linux_x86_64'
 TEST_PACKAGE = '{0}=={1}'.format(TEST_PACKAGE_NAME, TEST_PACKAGE_VERSION)
-
-
-def _wagon(command):
-    process = subprocess.Popen(
+# A single, pure-Python wheel for tests which only need some wagon.
+TEST_SMALL_PACKAGE_NAME = 'six'
+TEST_SMALL_PACKAGE_VERSION = '1.16.0'
+TEST_SMALL_PACKAGE = '{0}=={1}'.format(
+    TEST_SMALL_PACKAGE_NAME, TEST_SMALL_PACKAGE_VERSION)
+# Added through requirement files on top of TEST_PACKAGE.
+TEST_EXTRA_REQUIREMENTS = ['virtualenv==13.1.2', 'wheel']
+
+# Tests which download packages from PyPI or GitHub only run when
+# WAGON_RUN_NETWORK_TESTS is set.
+integration = pytest.mark.skipif(
+    not os.environ.get('WAGON_RUN_NETWORK_TESTS'),
+    reason='Set WAGON_RUN_NETWORK_TESTS=1 to run tests which need network')
+# Tests which build wagons from PyPI dominate the suite's run time.
+# `pytest -m "not slow"` skips them.
+slow = pytest.mark.slow
+
+
+def _wagon(command, capture=True):
+    """Run wagon's CLI in a new interpreter.
+
+    Unless `capture` is True, the output is discarded rather than piped
+    back, and only the return code is available.
+    """
+    output = subprocess.PIPE if capture else subprocess.DEVNULL
+    result = subprocess.run(
         [sys.executable, '-m', 'wagon'] + command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
+        stdout=output,
+        stderr=output,
+        universal_newlines=True
     )
-    stdout, stderr = process.communicate()
-    process.command = command
-    process.stdout, process.stderr = \
-        stdout.decode('utf8'), stderr.decode('utf8')
-    return process
+    result.command = command
+    return result
 
 
 def _parse(command):
-    sys.argv = command.split()
-    wagon.main()
+    """Run wagon's CLI in-process.
+
+    `command` is either an argv list or a string of space separated
+    arguments, starting with `wagon`. Commands containing paths should
+    be passed as a list.
+    """
+    argv = command.split() if isinstance(command, str) else command
+    wagon.main(argv[1:])
+
+
+@pytest.fixture(scope='session')
+def base_venv(tmp_path_factory):
+    """A virtualenv shared by all tests which don't modify it."""
+    return wagon._make_virtualenv(str(tmp_path_factory.mktemp('venv')))
+
+
+@pytest.fixture
+def venv(base_venv, tmp_path):
+    """A copy of `base_venv` which the test is free to modify."""
+    venv = str(tmp_path / 'venv')
+    shutil.copytree(base_venv, venv, symlinks=True)
+    return venv
+
+
+@pytest.fixture(scope='session')
+def wheelhouse(tmp_path_factory):
+    """Build the wheels for the test packages once, and point every later
+    pip run at them so that it doesn't download and build them again.
+    """
+    wheelhouse = str(tmp_path_factory.mktemp('wheelhouse'))
+    subprocess.check_call([
+        sys.executable, '-m', 'pip', 'wheel',
+        '--wheel-dir', wheelhouse, TEST_PACKAGE, TEST_SMALL_PACKAGE] +
+        TEST_EXTRA_REQUIREMENTS)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv('PIP_FIND_LINKS', wheelhouse)
+        yield wheelhouse
+
+
+class _QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def http_server(tmp_path_factory):
+    """Serve the files in a temporary directory over HTTP on localhost.
+
+    Yields the directory and the base URL it is served from.
+    """
+    root = tmp_path_factory.mktemp('http')
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        functools.partial(_QuietHTTPRequestHandler, directory=str(root)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, 'http://127.0.0.1:{0}/'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='session')
+def cached_url(request, tmp_path_factory):
+    """A function which downloads a URL once and returns a file:// URL to
+    the downloaded copy.
+
+    Downloads are kept in pytest's cache directory, so that later runs
+    don't download them again.
+    """
+    cache = getattr(request.config, 'cache', None)
+    if cache is not None:
+        cache_dir = str(cache.mkdir('wagon-downloads'))
+    else:
+        cache_dir = str(tmp_path_factory.mktemp('downloads'))
+
+    def cached(url):
+        path = os.path.join(
+            cache_dir, url.split('://', 1)[-1].replace('/', '_'))
+        if not os.path.isfile(path):
+            # Download next to the destination and move it into place,
+            # so that concurrent test processes never see partial files.
+            fd, partial_path = tempfile.mkstemp(dir=cache_dir)
+            os.close(fd)
+            wagon._download_file(url, partial_path)
+            os.replace(partial_path, path)
+        return pathlib.Path(path).as_uri()
+
+    return cached
+
+
+@pytest.fixture
+def local_pypi(http_server):
+    """Serve canned PyPI metadata for TEST_PACKAGE_NAME from the local
+    HTTP server, and point wagon's PyPI lookups at it.
+    """
+    root, url = http_server
+    package_path = root / 'pypi' / TEST_PACKAGE_NAME
+    package_path.mkdir(parents=True, exist_ok=True)
+    (package_path / 'json').write_text(json.dumps({
+        'info': {'name': TEST_PACKAGE_NAME, 'version': TEST_PACKAGE_VERSION}
+    }))
+    wagon._get_package_info_from_url.cache_clear()
+    with mock.patch('wagon.DEFAULT_INDEX_SOURCE_URL_TEMPLATE',
+                    url + 'pypi/{0}/json'):
+        yield
+    wagon._get_package_info_from_url.cache_clear()
+
+
+@pytest.fixture(scope='session')
+def package_tar_url(http_server):
+    """The URL of a tar.gz source archive of the test package."""
+    root, url = http_server
+    test_package = os.path.join(
+        os.path.dirname(__file__),
+        'resources',
+        'test-package',
+    )
+    with closing(tarfile.open(
+            str(root / 'test-package.tar.gz'), 'w:gz')) as tar:
+        for filename in ('setup.py', 'requirements.txt'):
+            tar.add(os.path.join(test_package, filename),
+                    arcname='test-package/{0}'.format(filename))
+    return url + 'test-package.tar.gz'
 
 
 class TestBase:
+    @pytest.fixture(autouse=True)
+    def _chdir(self, tmp_path, monkeypatch):
+        # Tests write their output files (e.g. 'file', 'tar.file') to
+        # the working directory, which is kept separate for each test.
+        monkeypatch.chdir(tmp_path)
+
     def test_run(self):
         proc = wagon._run('uname')
         assert proc.returncode == 0
 
-    def test_download_file(self):
-        fd, path = tempfile.mkstemp()
-        os.close(fd)
-        wagon._download_file(TEST_TAR, path)
-        try:
-            os.remove(path)
-        except Exception:
-            pytest.xfail(
-                "Failed to remove file, which means it was not downloaded")
+    def test_download_file(self, package_tar_url):
+        wagon._download_file(package_tar_url, 'file')
+        assert tarfile.is_tarfile('file')
+
+    def test_download_local_file(self, tmp_path):
+        source = tmp_path / 'source'
+        content = os.urandom(3 * wagon.DOWNLOAD_BUFFER_SIZE // 2)
+        source.write_bytes(content)
+        wagon._download_file(source.as_uri(), 'file')
+        with open('file', 'rb') as f:
+            assert f.read() == content
 
-    def test_download_file_missing(self):
+    def test_download_file_missing(self, http_server):
+        _, url = http_server
         with pytest.raises(wagon.WagonError) as ex:
-            wagon._download_file('http://www.google.com/x.tar.gz', 'file')
+            wagon._download_file(url + 'x.tar.gz', 'file')
         assert "Failed to download file" in str(ex)
 
     def test_download_bad_url(self):
@@ -79,25 +234,115 @@ class TestBase:
             wagon._download_file('something', 'file')
         assert "unknown url type: 'something'" in str(ex.value)
 
-    def test_download_missing_path(self):
+    def test_download_missing_path(self, package_tar_url):
         with pytest.raises(IOError) as ex:
-            wagon._download_file(TEST_TAR, 'x/file')
+            wagon._download_file(package_tar_url, 'x/file')
         assert 'No such file or directory' in str(ex.value)
 
-    def test_tar(self):
-        tempdir = tempfile.mkdtemp()
-        with open(os.path.join(tempdir, 'content.file'), 'w') as f:
-            f.write('CONTENT')
-        wagon._tar(tempdir, 'tar.file')
-        shutil.rmtree(tempdir, ignore_errors=True)
+    def test_tar(self, tmp_path):
+        source = tmp_path / 'source'
+        source.mkdir()
+        (source / 'content.file').write_text('CONTENT')
+        wagon._tar(str(source), 'tar.file')
         assert tarfile.is_tarfile('tar.file')
-        with closing(tarfile.open('tar.file', 'r:gz')) as tar:
-            members = tar.getnames()
-            dirname = os.path.split(tempdir)[1]
-            assert '{0}/content.file'.format(dirname) in members
-        os.remove('tar.file')
-
+        with closing(tarfile.open('tar.file', 'r|gz')) as tar:
+            assert any(member.name == 'source/content.file'
+                       for member in tar)
+
+    @mock.patch('wagon.which', return_value=None)
+    def test_tar_without_tar_executable(self, _, tmp_path):
+        self.test_tar(tmp_path)
+
+    @pytest.mark.skipif(
+        wagon.IS_WIN or not (wagon.which('tar') and wagon.which('gzip')),
+        reason='Requires tar and gzip executables')
+    def test_tar_with_parallel_compressor(self, tmp_path):
+        # gzip takes the same arguments as pigz, so we use it in its place
+        # to exercise the pipeline on machines without pigz.
+        executables = {'tar': wagon.which('tar'), 'pigz': wagon.which('gzip')}
+        with mock.patch('wagon.which', side_effect=executables.get):
+            self.test_tar(tmp_path)
+
+    @pytest.mark.skipif(
+        wagon.IS_WIN or not wagon.which('gzip'),
+        reason='Requires a gzip executable')
+    def test_tar_with_tarfile_and_parallel_compressor(self, tmp_path):
+        # Without a usable tar, `tarfile`'s output is piped into pigz.
+        executables = {'pigz': wagon.which('gzip')}
+        with mock.patch('wagon.which', side_effect=executables.get):
+            self.test_tar(tmp_path)
+            with pytest.raises(OSError):
+                wagon._tar('missing', 'file')
+        assert not os.path.isfile('file')
+
+    def test_tar_is_reproducible(self, tmp_path):
+        source = tmp_path / 'package'
+        (source / 'wheels').mkdir(parents=True)
+        for filename in ('package.json', 'wheels/a.whl', 'wheels/b.whl'):
+            (source / filename).write_text(filename)
+        wagon._tar(str(source), 'first.tar.gz')
+        for root, dirs, files in os.walk(str(source)):
+            for name in dirs + files:
+                os.utime(os.path.join(root, name), (1000, 1000))
+        wagon._tar(str(source), 'second.tar.gz')
+        with open('first.tar.gz', 'rb') as f:
+            first = f.read()
+        with open('second.tar.gz', 'rb') as f:
+            second = f.read()
+        assert first == second
+        with closing(tarfile.open('first.tar.gz')) as tar:
+            members = tar.getmembers()
+        assert [member.name for member in members] == [
+            'package', 'package/package.json', 'package/wheels',
+            'package/wheels/a.whl', 'package/wheels/b.whl']
+        assert all(member.mtime == 0 for member in members)
+        assert all(member.uid == 0 for member in members)
+
+    @mock.patch('wagon.which', return_value=None)
+    def test_tar_is_reproducible_without_tar_executable(self, _, tmp_path):
+        self.test_tar_is_reproducible(tmp_path)
+
+    def test_tar_long_names(self, tmp_path):
+        # Longer than ustar's 100 character name and 155 character prefix.
+        name = 'package/{0}/{1}'.format('d' * 120, 'f' * 120)
+        source = tmp_path / name
+        source.parent.mkdir(parents=True)
+        source.write_text('CONTENT')
+        wagon._tar(str(tmp_path / 'package'), 'tar.file')
+        with closing(tarfile.open('tar.file')) as tar:
+            assert tar.extractfile(name).read() == b'CONTENT'
+
+    @mock.patch('wagon.which', return_value=None)
+    def test_tar_long_names_without_tar_executable(self, _, tmp_path):
+        self.test_tar_long_names(tmp_path)
+
+    @pytest.mark.skipif(not hasattr(os, 'link'), reason='Requires hardlinks')
+    def test_untar_hardlinks_without_linking(self, tmp_path):
+        source = tmp_path / 'source'
+        source.mkdir()
+        (source / 'content.file').write_text('CONTENT')
+        os.link(str(source / 'content.file'), str(source / 'linked.file'))
+        with closing(tarfile.open('tar.file', 'w:gz')) as tar:
+            tar.add(str(source), arcname='source')
+        # When the link can't be created, its target is extracted again,
+        # which requires seeking back in the archive.
+        with mock.patch('os.link', side_effect=OSError):
+            wagon._untar('tar.file', str(tmp_path / 'extracted'))
+        for filename in ('content.file', 'linked.file'):
+            extracted = tmp_path / 'extracted' / 'source' / filename
+            assert extracted.read_text() == 'CONTENT'
+
+    @pytest.mark.skipif(
+        wagon.IS_WIN or not (wagon.which('tar') and wagon.which('gzip')),
+        reason='Requires tar and gzip executables')
     def test_tar_missing_source(self):
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon._tar('missing', 'file')
+        assert 'Failed to create tar archive: file' in str(ex.value)
+        assert not os.path.isfile('file')
+
+    @mock.patch('wagon.which', return_value=None)
+    def test_tar_missing_source_without_tar_executable(self, _):
         with pytest.raises(OSError) as ex:
             wagon._tar('missing', 'file')
         if wagon.IS_WIN:
@@ -106,39 +351,61 @@ class TestBase:
         else:
             assert "No such file or directory" in str(ex.value)
             assert "missing" in str(ex.value)
-        os.remove('file')
 
-    def test_make_virtualenv(self):
-        virtualenv_path = wagon._make_virtualenv()
-        try:
-            python_path = wagon._get_python_path(virtualenv_path)
-            assert os.path.isfile(python_path)
-        finally:
-            shutil.rmtree(virtualenv_path, ignore_errors=True)
+    def test_make_virtualenv(self, base_venv):
+        # base_venv is created by `_make_virtualenv`
+        python_path = wagon._get_python_path(base_venv)
+        assert os.path.isfile(python_path)
 
     def test_wheel_nonexisting_package(self):
-        try:
-            with pytest.raises(wagon.WagonError) as ex:
-                wagon.wheel('cloudify-script-plug==1.3')
-            assert 'Failed to download wheels for:' in str(ex)
-        finally:
-            shutil.rmtree('package', ignore_errors=True)
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon.wheel('cloudify-script-plug==1.3')
+        assert 'Failed to download wheels for:' in str(ex)
 
     def test_wheel_nonexisting_package_in_requirements_file(self):
-        fd, requirements_file_path = tempfile.mkstemp()
-        os.close(fd)
-        with open(requirements_file_path, 'w') as requirements_file:
+        with open('requirements.txt', 'w') as requirements_file:
             requirements_file.write('non_existing_package')
 
-        try:
-            with pytest.raises(wagon.WagonError) as ex:
-                wagon.wheel(
-                    package='wheel',
-                    requirement_files=[requirements_file_path])
-            assert 'Failed to download wheels for:' in str(ex)
-        finally:
-            shutil.rmtree('package', ignore_errors=True)
-            os.remove(requirements_file_path)
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon.wheel(
+                package='wheel',
+                requirement_files=['requirements.txt'])
+        assert 'Failed to download wheels for:' in str(ex)
+
+    def test_wheel_dependency_only_in_requirements_file(self, tmp_path):
+        for name, requires in (('depb', []), ('pkga', ['depb'])):
+            package_path = tmp_path / name
+            package_path.mkdir()
+            (package_path / 'setup.py').write_text(
+                'from setuptools import setup\n'
+                'setup(name={0!r}, version="1.0", install_requires={1!r})\n'
+                .format(name, requires))
+        requirements_file = tmp_path / 'requirements.txt'
+        requirements_file.write_text(str(tmp_path / 'depb'))
+
+        wheels = wagon.wheel(
+            package=str(tmp_path / 'pkga'),
+            requirement_files=[str(requirements_file)],
+            wheels_path=str(tmp_path / 'wheels'),
+            wheel_args='--no-index --no-build-isolation')
+        assert sorted(wheel.split('-')[:2] for wheel in wheels) == \
+            [['depb', '1.0'], ['pkga', '1.0']]
+
+    def test_wheel_does_not_cache_local_packages(self, tmp_path):
+        package_path = tmp_path / 'package'
+        package_path.mkdir()
+        (package_path / 'setup.py').write_text(
+            'from setuptools import setup\n'
+            'setup(name="package", version="1.0")\n')
+        wheel_cache = tmp_path / 'cache'
+
+        wheels = wagon.wheel(
+            package=str(package_path),
+            wheels_path=str(tmp_path / 'wheels'),
+            wheel_args='--no-index --no-build-isolation',
+            wheel_cache=str(wheel_cache))
+        assert len(wheels) == 1
+        assert os.listdir(str(wheel_cache)) == []
 
     @pytest.mark.skipif(not wagon.IS_WIN and not wagon.IS_LINUX,
                         reason='Not testing on all platforms')
@@ -146,18 +413,31 @@ class TestBase:
         assert ('win32' if wagon.IS_WIN else 'linux_x86_64') \
             in wagon.get_platform()
 
+    @pytest.mark.usefixtures('local_pypi')
     def test_get_version_from_pypi_bad_source(self):
         with pytest.raises(wagon.WagonError) as ex:
             wagon._get_package_info_from_pypi('NONEXISTING_PACKAGE')
         assert 'Failed to retrieve info for package' in str(ex)
 
-    def test_check_package_not_installed(self):
-        virtualenv_path = wagon._make_virtualenv()
-        try:
-            result = wagon._check_installed(TEST_PACKAGE_NAME, virtualenv_path)
-            assert not result
-        finally:
-            shutil.rmtree(virtualenv_path, ignore_errors=True)
+    @mock.patch('wagon._http_request',
+                return_value='{"info": {"name": "Flask"}}')
+    def test_get_package_info_from_pypi_is_cached(self, http_request):
+        get_package_info = wagon._get_package_info_from_pypi
+        wagon._get_package_info_from_url.cache_clear()
+        with mock.patch('wagon.DEFAULT_INDEX_SOURCE_URL_TEMPLATE',
+                        'http://index/{0}'):
+            assert get_package_info('flask') == {'name': 'Flask'}
+            assert get_package_info('flask') == {'name': 'Flask'}
+            http_request.assert_called_once_with('http://index/flask')
+            with mock.patch('time.monotonic', return_value=time.monotonic() +
+                            wagon.PACKAGE_INFO_CACHE_SECONDS):
+                assert get_package_info('flask') == {'name': 'Flask'}
+        assert http_request.call_count == 2
+        wagon._get_package_info_from_url.cache_clear()
+
+    def test_check_package_not_installed(self, base_venv):
+        result = wagon._check_installed(TEST_PACKAGE_NAME, base_venv)
+        assert not result
 
     def test_install_package_failed(self):
         with pytest.raises(wagon.WagonError) as ex:
@@ -184,20 +464,24 @@ class TestBase:
         expected_versions = ['py27', 'py26']
         assert versions == expected_versions
 
-    def test_get_downloaded_wheels(self):
-        tempdir = tempfile.mkdtemp()
-        fd, temp_wheel = tempfile.mkstemp(suffix='.whl', dir=tempdir)
-        os.close(fd)
-        fd, temp_non_wheel = tempfile.mkstemp(suffix='.zip', dir=tempdir)
-        os.close(fd)
-        temp_wheel_filename = os.path.basename(temp_wheel)
-        temp_non_wheel_filename = os.path.basename(temp_non_wheel)
-        try:
-            wheels = wagon._get_downloaded_wheels(tempdir)
-            assert temp_wheel_filename in wheels
-            assert temp_non_wheel_filename not in wheels
-        finally:
-            shutil.rmtree(tempdir, ignore_errors=True)
+    def test_get_downloaded_wheels(self, tmp_path):
+        (tmp_path / 'package-0.1-py3-none-any.whl').touch()
+        (tmp_path / 'package-0.1.zip').touch()
+        wheels = wagon._get_downloaded_wheels(str(tmp_path))
+        assert wheels == ['package-0.1-py3-none-any.whl']
+
+    def test_set_python_requires(self, dir_with_wheels):
+        requires_python = {
+            'Flask-0.12-py2.py3-none-any.whl': '>=3.6',
+            'click-6.7-py2.py3-none-any.whl': '>=3.6',
+        }
+
+        def wheel(wheel_path):
+            return mock.Mock(requires_python=requires_python.get(
+                os.path.basename(wheel_path)))
+
+        with mock.patch('wagon.Wheel', side_effect=wheel):
+            assert wagon._set_python_requires(dir_with_wheels) == '>=3.6'
 
     def test_construct_pip_command(self):
         package_name = 'package'
@@ -256,6 +540,194 @@ class TestBase:
         assert '--arg1' in generated_command
         assert '--arg2' in generated_command
 
+    def test_construct_wheel_command_with_wheel_cache(self):
+        generated_command = wagon._construct_wheel_command(
+            wheels_path='wheels_path',
+            package='package',
+            wheel_cache='cache')
+        expected_command = wagon._pip() + [
+            'wheel', '--wheel-dir', 'wheels_path',
+            '--find-links', 'wheels_path',
+            '--find-links', 'cache',
+            'package'
+        ]
+
+        assert generated_command == expected_command
+
+    def test_has_direct_requirements(self, tmp_path):
+        requirement_files = {
+            'index.txt': '# comment\n--index-url https://index/simple\n'
+                         'flask==1.0  # pinned\n',
+            'path.txt': './package\n',
+            'vcs.txt': 'git+https://github.com/org/repo.git#egg=repo\n',
+            'editable.txt': '-e package\n',
+            'includes.txt': '-r vcs.txt\n',
+            'includes_long.txt': '--requirement=vcs.txt\n',
+            'includes_attached.txt': '-rvcs.txt\n',
+        }
+        for filename, content in requirement_files.items():
+            (tmp_path / filename).write_text(content)
+
+        assert not wagon._has_direct_requirements(
+            [str(tmp_path / 'index.txt')])
+        for filename in ('path.txt', 'vcs.txt', 'editable.txt',
+                         'includes.txt', 'includes_long.txt',
+                         'includes_attached.txt', 'missing.txt'):
+            assert wagon._has_direct_requirements(
+                [str(tmp_path / filename)]), filename
+
+    def test_has_direct_requirement_args(self):
+        with open('index.txt', 'w') as f:
+            f.write('flask==1.0\n')
+        with open('path.txt', 'w') as f:
+            f.write('./package\n')
+
+        for args in ([], ['--pre', '--no-deps'], ['-r', 'index.txt'],
+                     ['--requirement=index.txt', 'flask==1.0']):
+            assert not wagon._has_direct_requirement_args(args), args
+        for args in (['-r', 'path.txt'], ['--constraint=path.txt'],
+                     ['-rpath.txt'], ['-e', 'package'],
+                     ['git+https://github.com/org/repo.git']):
+            assert wagon._has_direct_requirement_args(args), args
+
+    def test_cache_wheels(self, tmp_path):
+        wheels_path = tmp_path / 'wheels'
+        wheel_cache = tmp_path / 'cache'
+        wheels_path.mkdir()
+        wheel_cache.mkdir()
+        wheel_name = 'package-0.1-py3-none-any.whl'
+        (wheels_path / wheel_name).write_text('wheel_content')
+        wagon._cache_wheels(str(wheels_path), str(wheel_cache))
+        assert os.listdir(str(wheel_cache)) == [wheel_name]
+
+    def test_wheels_fingerprint(self):
+        requirement_file = 'requirements.txt'
+        open(requirement_file, 'w').close()
+        fingerprint = wagon._get_wheels_fingerprint(
+            TEST_PACKAGE, [requirement_file])
+        assert fingerprint == wagon._get_wheels_fingerprint(
+            TEST_PACKAGE, [requirement_file])
+        assert fingerprint != wagon._get_wheels_fingerprint(
+            TEST_PACKAGE, [requirement_file], wheel_args='--pre')
+        with open(requirement_file, 'w') as f:
+            f.write('wheel')
+        assert fingerprint != wagon._get_wheels_fingerprint(
+            TEST_PACKAGE, [requirement_file])
+
+    def test_wheels_fingerprint_with_requirements_in_wheel_args(self):
+        with open('requirements.txt', 'w') as f:
+            f.write('wheel')
+        fingerprint = wagon._get_wheels_fingerprint(
+            TEST_PACKAGE, wheel_args='-r requirements.txt')
+        with open('requirements.txt', 'w') as f:
+            f.write('wheel==0.43.0')
+        assert fingerprint != wagon._get_wheels_fingerprint(
+            TEST_PACKAGE, wheel_args='-r requirements.txt')
+
+    def test_reusable_wheels(self, tmp_path):
+        wheel_cache = str(tmp_path)
+        wheel_name = 'package-0.1-py3-none-any.whl'
+        assert wagon._get_reusable_wheels(wheel_cache, 'abc') is None
+        wagon._save_reusable_wheels(wheel_cache, 'abc', [wheel_name])
+        # The wheel itself is missing from the cache.
+        assert wagon._get_reusable_wheels(wheel_cache, 'abc') is None
+        (tmp_path / wheel_name).touch()
+        assert wagon._get_reusable_wheels(wheel_cache, 'abc') == [wheel_name]
+
+    @pytest.mark.parametrize('archive_format', ['zip', 'tar.gz'])
+    def test_show_reads_metadata_without_extracting(
+            self, archive_format, tmp_path):
+        package = tmp_path / 'package'
+        (package / 'wheels').mkdir(parents=True)
+        (package / 'wheels' / 'package-0.1-py3-none-any.whl').touch()
+        (package / wagon.METADATA_FILE_NAME).write_text(
+            json.dumps({'package_name': 'package', 'files': []}))
+        archive_path = str(tmp_path / 'package.wgn')
+        wagon._create_wagon_archive(
+            str(package), archive_path, archive_format)
+        with mock.patch('wagon.get_source') as get_source:
+            assert wagon.show(archive_path) == {
+                'package_name': 'package', 'files': []}
+            assert wagon.list_files(archive_path) == []
+        assert not get_source.called
+
+    def test_link_or_copy(self):
+        with open('source', 'w') as f:
+            f.write('CONTENT')
+        wagon._link_or_copy('source', 'linked')
+        assert os.path.samefile('source', 'linked')
+        with mock.patch('wagon.os.link', side_effect=OSError):
+            wagon._link_or_copy('source', 'copied')
+        assert not os.path.samefile('source', 'copied')
+        with open('copied') as f:
+            assert f.read() == 'CONTENT'
+
+    @mock.patch('wagon.subprocess.run')
+    def test_get_name_and_version_from_setup_py(self, run):
+        test_package = os.path.join(
+            os.path.dirname(__file__),
+            'resources',
+            'test-package',
+        )
+        name_and_version = wagon._get_name_and_version_from_setup(
+            test_package)
+        assert name_and_version == ('test-package', '0.0.1')
+        assert not run.called
+
+    @mock.patch('wagon.subprocess.run')
+    def test_get_name_and_version_from_setup_cfg(self, run):
+        with open('setup.py', 'w') as f:
+            f.write('from setuptools import setup\nsetup()\n')
+        with open('setup.cfg', 'w') as f:
+            f.write('[metadata]\nname = package\nversion = 1.0\n')
+        name_and_version = wagon._get_name_and_version_from_setup('.')
+        assert name_and_version == ('package', '1.0')
+        assert not run.called
+
+    def test_get_name_and_version_from_setup_fallback(self):
+        with open('setup.py', 'w') as f:
+            f.write('from setuptools import setup\n'
+                    'version = "1.0"\n'
+                    'setup(name="package", version=version)\n')
+        with mock.patch('wagon.subprocess.run',
+                        wraps=subprocess.run) as run:
+            name_and_version = wagon._get_name_and_version_from_setup('.')
+        assert name_and_version == ('package', '1.0')
+        assert run.called
+
+    @pytest.mark.parametrize('setup_py', [
+        'setup(name="foo", version="2.0")',
+        'version = "2.0"\nsetup(name="foo", version=version)',
+    ])
+    def test_get_name_and_version_prefers_setup_py(self, setup_py):
+        with open('setup.py', 'w') as f:
+            f.write('from setuptools import setup\n' + setup_py + '\n')
+        with open('setup.cfg', 'w') as f:
+            f.write('[metadata]\nname = bar\nversion = 1.0\n')
+        name_and_version = wagon._get_name_and_version_from_setup('.')
+        assert name_and_version == ('foo', '2.0')
+
+    @pytest.mark.parametrize('setup_files', [
+        {'setup.py': 'from setuptools import setup\n'
+                     'setup(name="package", version="1.0.0-beta")\n'},
+        {'setup.py': 'from setuptools import setup\nsetup()\n',
+         'setup.cfg': '[metadata]\nname = package\nversion = 1.0.0-beta\n'},
+    ])
+    def test_get_name_and_version_normalizes_version(self, setup_files):
+        for filename, content in setup_files.items():
+            with open(filename, 'w') as f:
+                f.write(content)
+        name_and_version = wagon._get_name_and_version_from_setup('.')
+        assert name_and_version == ('package', '1.0.0b0')
+
+    def test_get_name_and_version_from_broken_setup(self):
+        with open('setup.py', 'w') as f:
+            f.write('raise RuntimeError("broken")\n')
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon._get_name_and_version_from_setup('.')
+        assert 'Failed to retrieve name and version' in str(ex.value)
+        assert 'broken' in str(ex.value)
+
     def test_install_package_in_missing_venv(self):
         non_existing_venv = 'non_existing_venv'
         with pytest.raises(wagon.WagonError) as ex:
@@ -277,16 +749,12 @@ class TestBase:
 
 class TestCli:
 
-    def test_output_run_wagon_command_only(self):
+    def test_output_run_wagon_command_only(self, capsys):
         """Make sure we printout the help text when running `wagon`
-
-        On Windows, invoking wagon outputs something like:
-            usage: wagon.py [-h] [-v]
-        While on Linux:
-            usage: wagon [-h] [-v]
         """
-        result = _wagon([])
-        assert 'usage: wagon' in result.stdout
+        with pytest.raises(SystemExit):
+            wagon.parse_args([])
+        assert 'usage: wagon' in capsys.readouterr().out
 
     def test_errorcode_run_wagon_command_only(self):
         """Make sure we exit gracefully when running `wagon`.
@@ -298,46 +766,63 @@ class TestCli:
             _parse('wagon')
         assert str(ex.value) == '0'
 
+    def test_parse_args(self):
+        args = wagon.parse_args(['create', 'flask', '-t', 'tar.gz', '-v'])
+        assert args.SOURCE == 'flask'
+        assert args.format == 'tar.gz'
+        assert args.verbose
+        assert args.func is wagon._create_wagon
+
     def test_too_few_arguments(self):
         with pytest.raises(SystemExit) as ex:
-            _parse('wagon create')
+            wagon.parse_args(['create'])
 
         assert 'the following arguments are required' in str(ex.value)
 
     def test_bad_argument(self):
         with pytest.raises(SystemExit) as ex:
-            _parse('wagon create flask --non-existing-argument')
+            wagon.parse_args(['create', 'flask', '--non-existing-argument'])
         assert 'error: unrecognized arguments: --non-existing-argument' \
             in str(ex.value)
 
+    def test_bad_compress_level(self):
+        with pytest.raises(SystemExit) as ex:
+            wagon.parse_args(['create', 'flask', '--compress-level', '10'])
+        assert "argument --compress-level: invalid choice: 10" \
+            in str(ex.value)
+
 
 class TestGetPlatformForWheels:
     def test_get_platform_for_set_of_wheels(self, dir_with_wheels):
         wheel_platform = wagon._get_platform_for_set_of_wheels(dir_with_wheels)
         assert wheel_platform == 'linux_x86_64'
 
-    def _test_replatformed_wheels(self, expected_platform, dir_with_wheels):
+    @pytest.mark.parametrize('expected_platform',
+                             ['win32', 'manylinux1', 'any'])
+    def test_get_platform_for_set_of_replatformed_wheels(
+            self, expected_platform, dir_with_wheels):
         _replatform_wheels(dir_with_wheels, expected_platform)
         wheel_platform = wagon._get_platform_for_set_of_wheels(dir_with_wheels)
         assert wheel_platform == expected_platform
 
-    def test_get_platform_for_set_of_wheels_win32(self, dir_with_wheels):
-        expected_platform = 'win32'
-        self._test_replatformed_wheels(expected_platform, dir_with_wheels)
-
-    def test_get_platform_for_set_of_wheels_manylinux1(self, dir_with_wheels):
-        expected_platform = 'manylinux1'
-        self._test_replatformed_wheels(expected_platform, dir_with_wheels)
-
-    def test_get_platform_for_set_of_wheels_any(self, dir_with_wheels):
-        expected_platform = 'any'
-        self._test_replatformed_wheels(expected_platform, dir_with_wheels)
-
     def test_get_platform_for_set_of_wheels_still_linux(self, dir_with_wheels):
         _replatform_wheels(dir_with_wheels, 'manylinux1', once=True)
         wheel_platform = wagon._get_platform_for_set_of_wheels(dir_with_wheels)
         assert wheel_platform == 'linux_x86_64'
 
+    def test_get_platform_from_wheel_name(self):
+        assert wagon._get_platform_from_wheel_name(
+            'wheels/cffi-1.15.1-cp311-cp311-manylinux_2_17_x86_64.'
+            'manylinux2014_x86_64.whl') == \
+            'manylinux_2_17_x86_64.manylinux2014_x86_64'
+        assert wagon._get_platform_from_wheel_name(
+            'six-1.16.0-py2.py3-none-any.whl') == wagon.ALL_PLATFORMS_TAG
+
+    def test_scan_wheels(self, dir_with_wheels):
+        wheels, wheel_platform = wagon._scan_wheels(dir_with_wheels)
+        assert wheels == wagon._get_downloaded_wheels(dir_with_wheels)
+        assert wheel_platform == 'linux_x86_64'
+
 
 class TestIsPlatformSupported:
     def test_supported_platform_linux_on_linux(self):
@@ -404,21 +889,21 @@ def _replatform_wheels(dir_with_wheels, destination_platform, once=False):
 
     If once is True, only one wheel will be changed.
     """
-    for wheel in os.listdir(dir_with_wheels):
+    # The listing is read in full first, as wheels are renamed below.
+    with os.scandir(dir_with_wheels) as entries:
+        wheels = [entry.name for entry in entries if entry.is_file()]
+    for wheel in wheels:
         wheel_platform = wagon._get_platform_from_wheel_name(wheel)
         if wheel_platform != wagon.ALL_PLATFORMS_TAG:
-            new_wheel = wheel.replace(
-                wagon._get_platform_from_wheel_name(wheel),
-                destination_platform)
-            os.remove(os.path.join(dir_with_wheels, wheel))
-            with open(os.path.join(dir_with_wheels, new_wheel), 'w') as whl:
-                whl.write('wheel_content')
+            new_wheel = wheel.replace(wheel_platform, destination_platform)
+            os.replace(os.path.join(dir_with_wheels, wheel),
+                       os.path.join(dir_with_wheels, new_wheel))
             if once:
                 break
 
 
-@pytest.fixture
-def dir_with_wheels():
+@pytest.fixture(scope='module')
+def shared_dir_with_wheels(tmp_path_factory):
     wheels = [
         "MarkupSafe-0.23-cp27-cp27mu-linux_x86_64.whl",
         "Werkzeug-0.11.15-py2.py3-none-any.whl",
@@ -427,46 +912,108 @@ def dir_with_wheels():
         "itsdangerous-0.24-cp27-none-linux_x86_64.whl",
         "Flask-0.12-py2.py3-none-any.whl"
     ]
-    dir_with_wheels = tempfile.mkdtemp()
+    dir_with_wheels = tmp_path_factory.mktemp('wheels')
     for wheel in wheels:
-        with open(os.path.join(dir_with_wheels, wheel), 'w') as whl:
-            whl.write('wheel_content')
-    yield dir_with_wheels
-    shutil.rmtree(dir_with_wheels, ignore_errors=True)
+        (dir_with_wheels / wheel).write_text('wheel_content')
+    return dir_with_wheels
+
+
+@pytest.fixture
+def dir_with_wheels(shared_dir_with_wheels, tmp_path):
+    # Tests may replatform the wheels, so each gets its own copy.
+    dir_with_wheels = tmp_path / 'wheels'
+    shutil.copytree(shared_dir_with_wheels, dir_with_wheels)
+    return str(dir_with_wheels)
 
 
 class TestGetSource:
+    @pytest.fixture(autouse=True)
+    def _tempdir(self, tmp_path, monkeypatch):
+        # Sources are extracted to temporary directories, which we place
+        # under tmp_path so that they are cleaned up along with it.
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+
+    def _make_archive(self, *members):
+        for member in members:
+            if member.endswith('/'):
+                os.makedirs(member)
+            else:
+                open(member, 'w').close()
+        with closing(tarfile.open('package.tar.gz', 'w:gz')) as tar:
+            for member in members:
+                tar.add(member.rstrip('/'))
+        return os.path.abspath('package.tar.gz')
+
     def test_source_file_not_a_valid_archive(self):
-        fd, source_input = tempfile.mkstemp()
-        os.close(fd)
-        # In python2.6, an empty file can be opened as a tar archive.
-        # We fill it up so that it fails.
-        with open(source_input, 'w') as f:
-            f.write('something')
+        open('source_input', 'w').close()
 
-        try:
-            with pytest.raises(wagon.WagonError) as ex:
-                wagon.get_source(source_input)
-            assert 'Failed to extract' in str(ex)
-        finally:
-            os.remove(source_input)
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon.get_source('source_input')
+        assert 'Failed to extract' in str(ex)
+
+    def test_source_file_archive(self):
+        source_output = wagon.get_source(self._make_archive('package-0.1/'))
+        assert os.path.basename(source_output) == 'package-0.1'
+        assert os.path.isdir(source_output)
+
+    def test_source_tar_url_is_streamed(self):
+        source_input = self._make_archive('package-0.1/')
+        with mock.patch('wagon._download_file') as download_file:
+            source_output = wagon.get_source('file://' + source_input)
+        assert not download_file.called
+        assert os.path.basename(source_output) == 'package-0.1'
+        assert os.path.isdir(source_output)
+
+    def test_source_zip_url(self):
+        os.makedirs('package-0.1')
+        with closing(zipfile.ZipFile('package.zip', 'w')) as zip_file:
+            zip_file.write('package-0.1')
+        source_output = wagon.get_source(
+            'file://' + os.path.abspath('package.zip'))
+        assert os.path.basename(source_output) == 'package-0.1'
+        assert os.path.isdir(source_output)
+
+    def test_source_invalid_zip_url_leaves_nothing_behind(self, tmp_path):
+        open('package.zip', 'w').close()
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon.get_source('file://' + os.path.abspath('package.zip'))
+        assert 'Failed to extract package.zip' in str(ex)
+        assert os.listdir(str(tmp_path)) == ['package.zip']
+
+    def test_source_tar_url_serving_a_zip(self):
+        os.makedirs('package-0.1')
+        with closing(zipfile.ZipFile('package.tar.gz', 'w')) as zip_file:
+            zip_file.write('package-0.1')
+        source_output = wagon.get_source(
+            'file://' + os.path.abspath('package.tar.gz'))
+        assert os.path.basename(source_output) == 'package-0.1'
+        assert os.path.isdir(source_output)
+
+    def test_source_http_tar_url(self, package_tar_url):
+        source_output = wagon.get_source(package_tar_url)
+        assert os.path.basename(source_output) == 'test-package'
+        assert os.path.isfile(os.path.join(source_output, 'setup.py'))
+
+    def test_source_file_archive_without_directory(self):
+        source_input = self._make_archive('setup.py')
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon.get_source(source_input)
+        assert 'does not contain a package directory' in str(ex)
 
     def test_source_directory_not_a_package(self):
-        source_input = tempfile.mkdtemp()
-
-        try:
-            with pytest.raises(wagon.WagonError) as ex:
-                wagon.create(source_input)
-            assert 'Source directory must contain a setup.py file' in str(ex)
-        finally:
-            shutil.rmtree(source_input, ignore_errors=True)
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon.create('.')
+        assert 'Source directory must contain a setup.py file' in str(ex)
 
+    @pytest.mark.usefixtures('local_pypi')
     def test_source_pypi_no_version(self):
         source_input = TEST_PACKAGE_NAME
         source_output = wagon.get_source(source_input)
         assert source_output == \
             wagon._get_package_info_from_pypi(TEST_PACKAGE_NAME)['name']
 
+    @pytest.mark.usefixtures('local_pypi')
     def test_source_pypi_with_version(self):
         source_input = TEST_PACKAGE
         source_output = wagon.get_source(source_input)
@@ -482,46 +1029,54 @@ class TestCreateBadSources:
             wagon.create(source='ftp://x')
         assert 'Source URL type' in str(ex)
 
+    @mock.patch('wagon.wheel', side_effect=wagon.WagonError('failed'))
+    def test_work_directory_removed_on_failure(self, _, tmp_path):
+        test_package = os.path.join(
+            os.path.dirname(__file__),
+            'resources',
+            'test-package',
+        )
+        with mock.patch('wagon.tempfile.mkdtemp', return_value=str(tmp_path)):
+            with pytest.raises(wagon.WagonError):
+                wagon.create(source=test_package)
+        assert not tmp_path.exists()
+
 
+@integration
+@slow
+@pytest.mark.usefixtures('wheelhouse')
 class TestCreate:
+    @pytest.fixture(autouse=True)
+    def _chdir(self, tmp_path, monkeypatch):
+        # Each test creates its archives in its own directory, so tests
+        # can run concurrently (e.g. with `pytest -n auto`).
+        monkeypatch.chdir(tmp_path)
+
+    # These are the same for every test. Tests which build other
+    # archives override them on the instance.
+    if wagon.IS_WIN:
+        platform = output_platform = 'win32'
+    else:
+        platform = 'manylinux1_x86_64'
+        output_platform = 'linux_x86_64'
+    python_versions = [wagon._get_python_version()]
+    package_version = TEST_PACKAGE_VERSION
+    package_name = TEST_PACKAGE_NAME
+    archive_name = wagon._set_archive_name(
+        package_name,
+        package_version,
+        python_versions,
+        output_platform)
+    build_tag = ''
+
     def setup_method(self, test_method):
-        if wagon.IS_WIN:
-            self.platform = self.output_platform = 'win32'
-        else:
-            self.platform = 'manylinux1_x86_64'
-            self.output_platform = 'linux_x86_64'
-        self.python_versions = [wagon._get_python_version()]
-        self.package_version = TEST_PACKAGE_VERSION
-        self.package_name = TEST_PACKAGE_NAME
-        self.archive_name = wagon._set_archive_name(
-            self.package_name,
-            self.package_version,
-            self.python_versions,
-            self.output_platform)
         self.wagon_version = wagon._get_wagon_version()
-        self.build_tag = ''
 
-    def teardown_method(self, test_method):
-        if os.path.isfile(self.archive_name):
-            os.remove(self.archive_name)
-        if os.path.isdir(self.package_name):
-            shutil.rmtree(self.package_name, ignore_errors=True)
-
-    def _test(self, result, expected_number_of_wheels=5):
-        assert result.returncode == 0, (
-            'Error running {0!r}: {1}\n{2}'
-            .format(result.command, result.stdout, result.stderr)
-        )
+    def _test(self, archive_path, expected_number_of_wheels=5):
+        assert os.path.basename(archive_path) == self.archive_name
         assert os.path.isfile(self.archive_name)
 
-        try:
-            wagon._untar(self.archive_name, '.')
-        except Exception:
-            wagon._unzip(self.archive_name, '.')
-        with open(os.path.join(
-                self.package_name,
-                wagon.METADATA_FILE_NAME)) as f:
-            metadata = json.loads(f.read())
+        metadata = wagon.show(self.archive_name)
 
         assert self.wagon_version == metadata['created_by_wagon_version']
         assert self.package_version == metadata['package_version']
@@ -553,9 +1108,17 @@ class TestCreate:
 
         return metadata
 
-    def test_create_archive_from_pypi_with_version(self):
-        result = _wagon(['create', TEST_PACKAGE, '-v', '-f'])
-        metadata = self._test(result)
+    def test_create_archive_from_pypi_with_version(self, tmp_path):
+        # The other tests call `wagon.create` directly. This one covers
+        # creating through the CLI.
+        result = _wagon([
+            'create', TEST_PACKAGE, '-v', '-f',
+            '--wheel-cache', str(tmp_path / 'wheel-cache')])
+        assert result.returncode == 0, (
+            'Error running {0!r}: {1}\n{2}'
+            .format(result.command, result.stdout, result.stderr)
+        )
+        metadata = self._test(self.archive_name)
         assert metadata['package_source'] == TEST_PACKAGE
 
     def test_create_archive_from_pypi_with_build_tag(self):
@@ -567,53 +1130,52 @@ class TestCreate:
             self.output_platform,
             self.build_tag)
 
-        result = _wagon(['create', TEST_PACKAGE, '-v', '-f',
-                         '--build-tag', self.build_tag])
-        metadata = self._test(result)
+        archive_path = wagon.create(
+            TEST_PACKAGE, force=True, build_tag=self.build_tag)
+        metadata = self._test(archive_path)
         assert metadata['package_source'] == TEST_PACKAGE
         assert metadata['package_build_tag'] == '1b'
 
-    def test_create_zip_formatted_wagon_from_zip(self):
+    def test_create_zip_formatted_wagon_from_zip(self, cached_url):
         self.archive_name = wagon._set_archive_name(
             TEST_PACKAGE_NAME,
             TEST_PACKAGE_VERSION,
             self.python_versions,
             self.output_platform)
-        result = _wagon(['create', TEST_ZIP, '-v', '-f', '-t', 'tar.gz'])
-        metadata = self._test(result)
-        assert metadata['package_source'] == TEST_ZIP
+        source = cached_url(TEST_ZIP)
+        archive_path = wagon.create(
+            source, force=True, archive_format='tar.gz')
+        metadata = self._test(archive_path)
+        assert metadata['package_source'] == source
 
     def test_create_archive_from_pypi_with_additional_wheel_args(self):
-        with tempfile.NamedTemporaryFile(delete=False) as f:
-            f.write(b'virtualenv==13.1.2')
-        result = _wagon([
-            'create', TEST_PACKAGE, '-v', '-f',
-            '--wheel-args=-r {0}'.format(f.name),
-            '--keep-wheels'
-        ])
-        metadata = self._test(result=result, expected_number_of_wheels=7)
+        with open('requirements.txt', 'w') as f:
+            f.write('virtualenv==13.1.2')
+        archive_path = wagon.create(
+            TEST_PACKAGE,
+            force=True,
+            wheel_args='-r requirements.txt',
+            keep_wheels=True)
+        metadata = self._test(archive_path, expected_number_of_wheels=7)
         assert metadata['package_source'] == TEST_PACKAGE
         assert 'virtualenv-13.1.2-py2.py3-none-any.whl' in metadata['wheels']
 
     def test_create_archive_in_destination_dir_from_pypi_latest(self):
-        temp_dir = tempfile.mkdtemp()
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        # The destination directory doesn't exist, so create makes it.
+        destination = 'destination'
         package = 'wheel'
-        try:
-            pypi_version = \
-                wagon._get_package_info_from_pypi(package)['version']
-            self.archive_name = \
-                wagon._set_archive_name(
-                    package,
-                    pypi_version,
-                    self.python_versions,
-                    'any')
-            result = _wagon(['create', package, '-v', '-f', '-o', temp_dir])
-            assert result.returncode == 0
-            metadata = wagon.show(os.path.join(temp_dir, self.archive_name))
-            assert pypi_version == metadata['package_version']
-        finally:
-            shutil.rmtree(temp_dir, ignore_errors=True)
+        pypi_version = wagon._get_package_info_from_pypi(package)['version']
+        self.archive_name = \
+            wagon._set_archive_name(
+                package,
+                pypi_version,
+                self.python_versions,
+                'any')
+        archive_path = wagon.create(
+            package, force=True, archive_destination_dir=destination)
+        assert archive_path == os.path.join(destination, self.archive_name)
+        metadata = wagon.show(archive_path)
+        assert pypi_version == metadata['package_version']
 
     def test_create_with_requirements(self):
         test_package = os.path.join(
@@ -634,51 +1196,77 @@ class TestCreate:
         assert 'wheel' in wheel_names
         assert 'test_package' in wheel_names
 
-    def test_create_archive_from_path_and_validate(self):
-        source = wagon.get_source(TEST_TAR)
-        fd, requirements_file_path = tempfile.mkstemp()
-        os.close(fd)
-        with open(requirements_file_path, 'w') as requirements_file:
+    def test_create_archive_from_path_and_validate(self, cached_url):
+        source = wagon.get_source(cached_url(TEST_TAR))
+        with open('requirements.txt', 'w') as requirements_file:
             requirements_file.write('wheel')
-        result = _wagon([
-            'create', source, '-v', '-f', '--validate',
-            '--wheel-args=-r {0}'.format(requirements_file_path)
-        ])
-        try:
-            metadata = self._test(
-                result=result,
-                expected_number_of_wheels=7)
-        finally:
-            os.remove(requirements_file_path)
+        archive_path = wagon.create(
+            source,
+            force=True,
+            validate_archive=True,
+            wheel_args='-r requirements.txt')
+        metadata = self._test(archive_path, expected_number_of_wheels=7)
         assert metadata['package_source'] == source
         assert any(
             whl for whl in metadata['wheels'] if whl.startswith('wheel'))
 
     def test_create_archive_already_exists(self):
-        wagon.create(TEST_PACKAGE)
-        assert os.path.isfile(self.archive_name)
+        archive_path = wagon.create(TEST_SMALL_PACKAGE)
+        assert os.path.isfile(archive_path)
         with pytest.raises(wagon.WagonError) as ex:
-            wagon.create(TEST_PACKAGE)
+            wagon.create(TEST_SMALL_PACKAGE)
         assert 'Destination archive already exists:' in str(ex)
 
     def test_create_archive_already_exists_force(self):
-        wagon.create(TEST_PACKAGE)
-        assert os.path.isfile(self.archive_name)
-        wagon.create(TEST_PACKAGE, force=True)
-        assert os.path.isfile(self.archive_name)
+        archive_path = wagon.create(TEST_SMALL_PACKAGE)
+        assert os.path.isfile(archive_path)
+        assert wagon.create(TEST_SMALL_PACKAGE, force=True) == archive_path
+        assert os.path.isfile(archive_path)
 
     def test_fail_create(self):
         with pytest.raises(SystemExit) as ex:
-            _parse('wagon create non_existing_package -v -f')
+            _parse('wagon create non_existing_package -v -f --wheel-cache=')
         assert 'Failed to retrieve info for package' in str(ex)
 
-    def test_create_with_files(self):
+    def test_create_with_files_and_keep_wheels(self, tmp_path):
         test_package = os.path.join(
             os.path.dirname(__file__),
             'resources',
             'test-package',
         )
-        temp_dir_path = tempfile.mkdtemp()
+        file_path = tmp_path / 'test.yaml'
+        file_path.write_text('TEST_CONTENT')
+        mkdtemp = tempfile.mkdtemp
+        tempdirs = []
+
+        def record_mkdtemp(*args, **kwargs):
+            tempdirs.append(mkdtemp(*args, **kwargs))
+            return tempdirs[-1]
+
+        with mock.patch('wagon.tempfile.mkdtemp', side_effect=record_mkdtemp):
+            wagon.create(
+                source=test_package,
+                force=True,
+                add_file=[str(file_path)],
+                keep_wheels=True,
+            )
+        try:
+            kept_file_path = os.path.join(
+                tempdirs[0], 'test-package', 'files', 'test.yaml')
+            # The kept work directory must not share the added file.
+            assert not os.path.samefile(str(file_path), kept_file_path)
+        finally:
+            for tempdir in tempdirs:
+                shutil.rmtree(tempdir, ignore_errors=True)
+
+    def test_create_with_files(self, tmp_path):
+        test_package = os.path.join(
+            os.path.dirname(__file__),
+            'resources',
+            'test-package',
+        )
+        temp_dir_path = str(tmp_path / 'files')
+        os.makedirs(temp_dir_path)
         temp_filename = 'test.yaml'
         temp_file_path = os.path.join(temp_dir_path, temp_filename)
         temp_file_content = 'TEST_CONTENT'
@@ -709,58 +1297,78 @@ class TestCreate:
 
         assert temp_file_content == file_content
 
-        shutil.rmtree(
-            temp_dir_path,
-            ignore_errors=True,
-        )
+
+@pytest.fixture(scope='session')
+def shared_wagon_archive(wheelhouse, tmp_path_factory):
+    """Create the TEST_SMALL_PACKAGE wagon once for all tests that only need
+    an existing archive.
+
+    Tests should use the `wagon_archive` fixture, which gives each of
+    them its own copy.
+    """
+    return wagon.create(
+        source=TEST_SMALL_PACKAGE,
+        archive_destination_dir=str(tmp_path_factory.mktemp('shared')))
+
+
+@pytest.fixture(scope='session')
+def shared_wagon_metadata(shared_wagon_archive):
+    return wagon.show(shared_wagon_archive)
+
+
+@pytest.fixture
+def wagon_archive(shared_wagon_archive, tmp_path):
+    archive_path = str(tmp_path / os.path.basename(shared_wagon_archive))
+    shutil.copy(shared_wagon_archive, archive_path)
+    return archive_path
 
 
+@integration
+@slow
+@pytest.mark.usefixtures('wheelhouse')
 class TestInstall:
-    def setup_method(self, test_method):
-        shutil.rmtree('test_env', ignore_errors=True)
-        wagon._make_virtualenv('test_env')
-        self.archive_path = wagon.create(
-            source=TEST_PACKAGE,
-            force=True)
-
-    def teardown_method(self, test_method):
-        os.remove(self.archive_path)
-        if os.path.isdir('test_env'):
-            shutil.rmtree('test_env', ignore_errors=True)
-
-    def test_install_package_from_local_archive(self, tmpdir):
-        # make a virtualenv and install wagon there, and use that venv for
+    @pytest.fixture(autouse=True)
+    def _setup(self, wagon_archive):
+        self.archive_path = wagon_archive
+
+    def test_install_package_from_local_archive(self, venv):
+        # install wagon in a virtualenv, and use that venv for
         # testing installation
-        venv = 'test_env'
-        assert not wagon._check_installed(TEST_PACKAGE_NAME, venv=venv)
+        assert not wagon._check_installed(TEST_SMALL_PACKAGE_NAME, venv=venv)
         python = wagon._get_python_path(venv)
         wagon._run(wagon._pip(venv) + [
             'install', os.path.dirname(wagon.__file__)
         ])
-        assert not wagon._check_installed(TEST_PACKAGE_NAME, venv=venv)
+        assert not wagon._check_installed(TEST_SMALL_PACKAGE_NAME, venv=venv)
         wagon._run([
             python, '-m', 'wagon', 'install', self.archive_path, '-v', '-u'
         ])
-        assert wagon._check_installed(TEST_PACKAGE_NAME, venv=venv)
+        assert wagon._check_installed(TEST_SMALL_PACKAGE_NAME, venv=venv)
 
     def test_fail_install(self):
-        result = _wagon(['install', 'non_existing_archive', '-v', '-u'])
+        result = _wagon(
+            ['install', 'non_existing_archive', '-v', '-u'], capture=False)
         assert result.returncode == 1
 
     @mock.patch('wagon.get_platform', return_value='weird_platform')
-    def test_fail_install_unsupported_platform(self, _):
-        with pytest.raises(SystemExit) as ex:
-            _parse("wagon install {0} -v -u".format(self.archive_path))
+    def test_fail_install_unsupported_platform(self, _, tmp_path):
+        # The shared archive supports any platform.
+        archive_path = wagon.create(
+            TEST_SMALL_PACKAGE,
+            archive_destination_dir=str(tmp_path),
+            supported_platform=TEST_PACKAGE_PLATFORM)
+        with pytest.raises(wagon.WagonError) as ex:
+            wagon.install(archive_path, upgrade=True)
         assert 'Platform unsupported for wagon (weird_platform)' in str(ex)
 
 
+@integration
+@slow
+@pytest.mark.usefixtures('wheelhouse')
 class TestValidate:
-    def setup_method(self, test_method):
-        self.archive_path = wagon.create(source=TEST_PACKAGE)
-
-    def teardown_method(self, test_method):
-        if os.path.isfile(self.archive_path):
-            os.remove(self.archive_path)
+    @pytest.fixture(autouse=True)
+    def _setup(self, wagon_archive):
+        self.archive_path = wagon_archive
 
     def test_validate_package(self):
         result = _wagon(['validate', self.archive_path, '-v'])
@@ -769,25 +1377,18 @@ class TestValidate:
             .format(result.command, result.stdout, result.stderr)
         )
 
-    def test_fail_validate_invalid_wagon(self):
-        fd, invalid_wagon = tempfile.mkstemp()
-        os.close(fd)
-        # In python2.6, an empty file can be opened as a tar archive.
-        # We fill it up so that it fails.
-        with open(invalid_wagon, 'w') as f:
-            f.write('something')
+    def test_fail_validate_invalid_wagon(self, tmp_path):
+        invalid_wagon = tmp_path / 'invalid.wgn'
+        invalid_wagon.touch()
 
-        try:
-            with pytest.raises(SystemExit) as ex:
-                _parse('wagon validate {0}'.format(invalid_wagon))
-            assert 'Failed to extract' in str(ex)
-        finally:
-            os.remove(invalid_wagon)
+        with pytest.raises(SystemExit) as ex:
+            _parse(['wagon', 'validate', str(invalid_wagon)])
+        assert 'Failed to extract' in str(ex)
 
     @mock.patch('wagon.validate', return_value=['...'])
     def test_exit_on_failed_validation(self, _):
         with pytest.raises(SystemExit) as ex:
-            _parse('wagon validate {0} -v'.format(self.archive_path))
+            _parse(['wagon', 'validate', self.archive_path, '-v'])
         assert str(ex.value) == '1'
 
     @mock.patch('wagon._check_installed', return_value=False)
@@ -796,13 +1397,7 @@ class TestValidate:
         assert 'failed to install' in result[0]
         assert len(result) == 1
 
-    @mock.patch('wagon._check_installed', return_value=False)
-    def test_fail_validate_in_nonexisting_venv(self, _):
-        result = wagon.validate(self.archive_path)
-        assert 'failed to install' in result[0]
-        assert len(result) == 1
-
-    def test_fail_validation_exclude_and_missing_wheel(self):
+    def test_fail_validation_exclude_and_missing_wheel(self, tmp_path):
         test_package = os.path.join(
             os.path.dirname(__file__),
             'resources',
@@ -811,47 +1406,41 @@ class TestValidate:
         requirement_files = [os.path.join(test_package, 'requirements.txt')]
         archive_path = wagon.create(source=test_package,
                                     requirement_files=requirement_files,
+                                    archive_destination_dir=str(tmp_path),
                                     force=True)
-        archive_name = os.path.basename(archive_path)
-        tempdir = tempfile.mkdtemp()
-        try:
-            wagon._unzip(archive_name, tempdir)
-            wheels_dir = os.path.join(
-                tempdir, 'test-package', wagon.DEFAULT_WHEELS_PATH)
-            for wheel in os.listdir(wheels_dir):
-                if wheel.startswith('wheel'):
-                    break
-            wheel_to_delete = os.path.join(wheels_dir, wheel)
-            os.remove(wheel_to_delete)
-            wagon._tar(
-                os.path.join(tempdir, 'test-package'), archive_name)
-            result = wagon.validate(archive_name)
-            assert len(result) == 1
-        finally:
-            shutil.rmtree(tempdir, ignore_errors=True)
-            if os.path.isfile(archive_name):
-                os.remove(archive_name)
+        # Copy the archive without the `wheel` wheel, rather than
+        # extracting it and archiving it again.
+        wheel_prefix = 'test-package/{0}/wheel'.format(
+            wagon.DEFAULT_WHEELS_PATH)
+        broken_archive_path = str(tmp_path / 'broken.wgn')
+        with closing(zipfile.ZipFile(archive_path)) as source:
+            with closing(zipfile.ZipFile(broken_archive_path, 'w')) as target:
+                wheel_to_delete = next(
+                    name for name in source.namelist()
+                    if name.startswith(wheel_prefix))
+                for member in source.infolist():
+                    if member.filename != wheel_to_delete:
+                        target.writestr(member, source.read(member))
+        result = wagon.validate(broken_archive_path)
+        assert len(result) == 1
 
 
+@integration
+@slow
+@pytest.mark.usefixtures('wheelhouse')
 class TestShowMetadata:
-    def setup_method(self, test_method):
-        self.archive_path = wagon.create(source=TEST_PACKAGE, force=True)
-        # wagon._unzip(self.archive_path, '.')
-        self.extracted_source = wagon.get_source(self.archive_path)
-        self.expected_metadata = wagon._get_metadata(self.extracted_source)
-
-    def teardown_method(self, test_method):
-        os.remove(self.archive_path)
-        shutil.rmtree(self.extracted_source, ignore_errors=True)
+    @pytest.fixture(autouse=True)
+    def _setup(self, wagon_archive):
+        self.archive_path = wagon_archive
 
-    def test_show_metadata_for_archive(self):
+    def test_show_metadata_for_archive(self, shared_wagon_metadata):
         # merely invoke it directly for coverage sake
-        _parse('wagon show {0} -v'.format(self.archive_path))
+        _parse(['wagon', 'show', self.archive_path, '-v'])
         result = _wagon(['show', self.archive_path])
         assert result.returncode == 0
         # Remove the first line
         resulting_metadata = json.loads(result.stdout)
-        assert resulting_metadata == self.expected_metadata
+        assert resulting_metadata == shared_wagon_metadata
 
     def test_fail_show_metadata_for_non_existing_archive(self):
         with pytest.raises(SystemExit) as ex:
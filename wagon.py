@@ -17,33 +17,40 @@ from __future__ import print_function
 
 import os
 import sys
+import ast
+import gzip
 import time
 import json
 import shlex
 import shutil
+import hashlib
 import tarfile
 import zipfile
 import logging
 import argparse
+import functools
+import configparser
 import tempfile
 import subprocess
 import importlib.metadata
+import concurrent.futures
 import sysconfig
 import venv
 from io import StringIO
 from threading import Thread
 from contextlib import closing
 from shutil import which
-from pkginfo import Wheel
+from pkginfo import Wheel, UnpackedSDist
+from packaging.version import Version, InvalidVersion
 
 try:
     import urllib.error
     from urllib.request import urlopen
-    from urllib.request import URLopener
+    from urllib.parse import urlparse
 except ImportError:
     import urllib
     from urllib import urlopen
-    from urllib import URLopener
+    from urlparse import urlparse
 
 try:
     from distro import linux_distribution
@@ -60,6 +67,8 @@ DESCRIPTION = \
 METADATA_FILE_NAME = 'package.json'
 DEFAULT_WHEELS_PATH = 'wheels'
 DEFAULT_FILES_PATH = 'files'
+DEFAULT_WHEEL_CACHE_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'wagon', 'wheels')
 
 DEFAULT_INDEX_SOURCE_URL_TEMPLATE = 'https://pypi.python.org/pypi/{0}/json'
 IS_VIRTUALENV = sys.prefix != sys.base_prefix
@@ -71,8 +80,24 @@ IS_LINUX = PLATFORM.startswith('linux')
 
 ALL_PLATFORMS_TAG = 'any'
 
+# Wheels are already compressed, so higher levels cost a lot of CPU time
+# for a negligible reduction in size.
+DEFAULT_COMPRESS_LEVEL = 6
+
 PROCESS_POLLING_INTERVAL = 0.1
 
+# Downloads are copied to disk in large chunks to keep the number of
+# read and write calls low.
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+# `tarfile` copies member data in 16KiB chunks by default. Setting
+# `copybufsize` on an archive is ignored before Python 3.8.
+TAR_COPY_BUFFER_SIZE = 1024 * 1024
+
+# PyPI lookups are kept for a short while only, so that a long running
+# process still resolves a package name to its latest release.
+PACKAGE_INFO_CACHE_SECONDS = 60
+
 
 def setup_logger():
     handler = logging.StreamHandler(sys.stdout)
@@ -119,14 +144,21 @@ class PipeReader(Thread):
 
     def run(self):
         while self.process.poll() is None:
-            output = self.fd.readline().strip().decode('utf-8')
-            if len(output) > 0:
-                self._aggr.write(output)
-                self.logger.log(self.log_level, output)
-            else:
+            if not self._handle(self.fd.readline()):
                 time.sleep(PROCESS_POLLING_INTERVAL)
+        # Short-lived processes may exit before we got to read their
+        # output, so we consume whatever is left in the pipe.
+        for line in self.fd:
+            self._handle(line)
         self.aggr = self._aggr.getvalue()
 
+    def _handle(self, line):
+        output = line.strip().decode('utf-8')
+        if len(output) > 0:
+            self._aggr.write(output)
+            self.logger.log(self.log_level, output)
+        return output
+
 
 def _run(cmd, suppress_errors=False, suppress_output=False):
     """Execute a command
@@ -159,6 +191,41 @@ def _run(cmd, suppress_errors=False, suppress_output=False):
     return process
 
 
+def _run_pipeline(producer_cmd, consumer_cmd, destination):
+    """Execute `producer_cmd | consumer_cmd > destination`
+
+    Returns both processes, each with its aggregated stderr.
+    """
+    if is_verbose():
+        logger.debug(
+            'Executing: %r | %r > %s', producer_cmd, consumer_cmd, destination)
+    with open(destination, 'wb') as output:
+        producer = subprocess.Popen(
+            producer_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        consumer = subprocess.Popen(
+            consumer_cmd,
+            stdin=producer.stdout,
+            stdout=output,
+            stderr=subprocess.PIPE)
+        # Close our copy of the pipe so that the producer receives a
+        # SIGPIPE if the consumer exits early.
+        producer.stdout.close()
+
+        processes = (producer, consumer)
+        stderr_threads = [
+            PipeReader(process.stderr, process, logger, logging.NOTSET)
+            for process in processes]
+        for thread in stderr_threads:
+            thread.start()
+        for process in processes:
+            process.wait()
+        for process, thread in zip(processes, stderr_threads):
+            thread.join()
+            process.aggr_stderr = thread.aggr
+
+    return processes
+
+
 class WagonError(Exception):
     pass
 
@@ -166,13 +233,16 @@ class WagonError(Exception):
 def _construct_wheel_command(wheels_path='package',
                              wheel_args=None,
                              requirement_files=None,
-                             package=None, pip_path=None):
+                             package=None, pip_path=None,
+                             wheel_cache=None):
     pip = [pip_path] if pip_path else _pip()
     wheel_cmd = pip + [
         'wheel',
         '--wheel-dir', wheels_path,
         '--find-links', wheels_path
     ]
+    if wheel_cache:
+        wheel_cmd += ['--find-links', wheel_cache]
     if wheel_args:
         if not isinstance(wheel_args, list):
             wheel_args = shlex.split(wheel_args, posix=not IS_WIN)
@@ -187,33 +257,244 @@ def _construct_wheel_command(wheels_path='package',
     return wheel_cmd
 
 
+def _link_or_copy(source, destination):
+    """Hardlink `source` to `destination`, copying it if linking fails.
+
+    Linking fails across filesystems and on filesystems that don't
+    support hardlinks, in which case we fall back to a regular copy.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _is_direct_requirement(requirement):
+    """Return whether `requirement` is a local path, a URL or a VCS link
+    rather than a project on an index.
+
+    Wheels built from these may change without their version changing,
+    so they must not be cached.
+    """
+    requirement = requirement.strip()
+    return requirement.startswith(('-e', '--editable', '.')) or \
+        '://' in requirement or \
+        os.path.isabs(requirement) or \
+        os.path.exists(requirement)
+
+
+def _split_pip_args(args):
+    """Return pip arguments given either as a list or as a string."""
+    if args and not isinstance(args, list):
+        return shlex.split(args, posix=not IS_WIN)
+    return args or []
+
+
+def _get_included_file(arg):
+    """Return the file named by a `-r`/`-c` pip option, e.g. `-r file`,
+    `-rfile` or `--requirement=file`.
+
+    An empty string is returned if the file is passed as the next
+    argument, and None if `arg` isn't such an option at all.
+    """
+    for option in ('--requirement', '--constraint'):
+        if arg == option:
+            return ''
+        if arg.startswith(option + '='):
+            return arg[len(option) + 1:]
+    if arg.startswith(('-r', '-c')):
+        return arg[2:]
+    return None
+
+
+def _has_direct_requirements(requirement_files):
+    """Return whether any of the `requirement_files` (or the files they
+    include) contains a direct requirement.
+
+    Requirement files which aren't local files (e.g. URLs) can't be
+    inspected, so they are assumed to contain one.
+    """
+    for requirement_file in requirement_files or []:
+        if not os.path.isfile(requirement_file):
+            return True
+        with open(requirement_file) as requirements:
+            for line in requirements:
+                line = line.split(' #')[0].strip()
+                if not line or line.startswith('#'):
+                    continue
+                option, _, value = line.partition(' ')
+                included_file = _get_included_file(option)
+                if included_file is not None:
+                    included_file = os.path.join(
+                        os.path.dirname(requirement_file),
+                        included_file or value.strip())
+                    if _has_direct_requirements([included_file]):
+                        return True
+                elif option in ('-e', '--editable') or \
+                        not line.startswith('-'):
+                    if _is_direct_requirement(line):
+                        return True
+    return False
+
+
+def _has_direct_requirement_args(args):
+    """Return whether the pip arguments `args` contain a direct
+    requirement, either themselves or in the files they include.
+
+    Arguments which aren't options are regarded as requirements, even
+    if they are the value of an option, as that can't be told apart.
+    """
+    args = iter(_split_pip_args(args))
+    for arg in args:
+        included_file = _get_included_file(arg)
+        if included_file is not None:
+            if _has_direct_requirements([included_file or next(args, '')]):
+                return True
+        elif arg.startswith('-') and \
+                not arg.startswith(('-e', '--editable')):
+            continue
+        elif _is_direct_requirement(arg):
+            return True
+    return False
+
+
+def _cache_wheels(wheels_path, wheel_cache, exclude=()):
+    """Copy new wheels into the cache.
+
+    Wheels in `exclude` are skipped. They are copied rather than
+    hardlinked, as `wheels_path` may be kept and its wheels changed.
+    """
+    for filename in _get_downloaded_wheels(wheels_path):
+        if filename in exclude:
+            continue
+        cached_path = os.path.join(wheel_cache, filename)
+        if os.path.isfile(cached_path):
+            continue
+        # The wheel is copied under a temporary name first, so that other
+        # builds using the cache never see a partially written wheel.
+        fd, temp_path = tempfile.mkstemp(dir=wheel_cache, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copy2(os.path.join(wheels_path, filename), temp_path)
+            os.replace(temp_path, cached_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+
+def _get_wheel_args_files(wheel_args):
+    """Return the requirement and constraint files named in `wheel_args`.
+    """
+    args = iter(_split_pip_args(wheel_args))
+    files = []
+    for arg in args:
+        included_file = _get_included_file(arg)
+        if included_file is not None:
+            files.append(included_file or next(args, ''))
+    return files
+
+
+def _get_wheels_fingerprint(source,
+                            requirement_files=None,
+                            wheel_args='',
+                            pip_paths=None):
+    """Return a digest of everything that determines which wheels
+    a build of `source` downloads.
+    """
+    fingerprint = hashlib.sha256()
+    for part in [source, repr(wheel_args), sys.version, PLATFORM] + \
+            [repr(pip_path) for pip_path in pip_paths or [None]]:
+        fingerprint.update(part.encode('utf-8') + b'\0')
+    requirement_files = list(requirement_files or []) + \
+        _get_wheel_args_files(wheel_args)
+    for requirement_file in requirement_files:
+        if os.path.isfile(requirement_file):
+            with open(requirement_file, 'rb') as f:
+                fingerprint.update(f.read())
+        else:
+            fingerprint.update(requirement_file.encode('utf-8'))
+        fingerprint.update(b'\0')
+    return fingerprint.hexdigest()
+
+
+def _get_wheels_manifest_path(wheel_cache, fingerprint):
+    return os.path.join(wheel_cache, 'builds', fingerprint + '.json')
+
+
+def _get_reusable_wheels(wheel_cache, fingerprint):
+    """Return the wheels of a previous build with the same fingerprint.
+
+    None is returned if there was no such build, or if any of its wheels
+    is no longer in the cache.
+    """
+    manifest_path = _get_wheels_manifest_path(wheel_cache, fingerprint)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as manifest:
+        wheels = json.load(manifest)
+    if all(os.path.isfile(os.path.join(wheel_cache, wheel))
+           for wheel in wheels):
+        return wheels
+    return None
+
+
+def _save_reusable_wheels(wheel_cache, fingerprint, wheels):
+    manifest_path = _get_wheels_manifest_path(wheel_cache, fingerprint)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'w') as manifest:
+        json.dump(wheels, manifest)
+
+
 def wheel(package,
           requirement_files=None,
           wheels_path='package',
           wheel_args=None,
-          pip_path=None):
+          pip_path=None,
+          wheel_cache=None):
+    """Download and build wheels for a package and its requirement files.
+
+    The requirement files are handled first so that the wheels built
+    from them (e.g. of local paths or VCS links) are found in
+    `wheels_path` when the package's dependencies are resolved.
+
+    If `wheel_cache` is provided, wheels found there are used instead of
+    downloading them again, and newly built wheels are added to it unless
+    they were built for local paths, URLs or VCS links.
+    """
     logger.info('Downloading Wheels for %s...', package)
 
+    # Direct requirements in the wheel args are passed to both pip runs.
+    args_cacheable = not _has_direct_requirement_args(wheel_args)
+
+    # Each target is what we report on failure, along with the arguments
+    # used to construct its pip command and whether its wheels can be
+    # cached.
+    targets = [(package, {'package': package},
+                args_cacheable and not _is_direct_requirement(package))]
     if requirement_files:
+        targets.insert(0, (
+            requirement_files,
+            {'requirement_files': requirement_files},
+            args_cacheable and
+            not _has_direct_requirements(requirement_files)))
+
+    os.makedirs(wheels_path, exist_ok=True)
+    if wheel_cache:
+        os.makedirs(wheel_cache, exist_ok=True)
+    for target, kwargs, cacheable in targets:
+        existing_wheels = set(_get_downloaded_wheels(wheels_path))
         wheel_command = _construct_wheel_command(
             wheels_path,
             wheel_args,
-            requirement_files,
-            pip_path=pip_path)
+            pip_path=pip_path,
+            wheel_cache=wheel_cache,
+            **kwargs)
         process = _run(wheel_command)
         if not process.returncode == 0:
-            raise WagonError('Failed to download wheels for: {0}'.format(
-                requirement_files))
-
-    wheel_command = _construct_wheel_command(
-        wheels_path,
-        wheel_args,
-        package=package,
-        pip_path=pip_path)
-    process = _run(wheel_command)
-    if not process.returncode == 0:
-        raise WagonError(
-            'Failed to download wheels for: {0}'.format(package))
+            raise WagonError(
+                'Failed to download wheels for: {0}'.format(target))
+        if wheel_cache and cacheable:
+            _cache_wheels(wheels_path, wheel_cache, exclude=existing_wheels)
 
     wheels = _get_downloaded_wheels(wheels_path)
 
@@ -289,8 +570,9 @@ def install_package(package,
 
 
 def _get_downloaded_wheels(path):
-    return sorted([filename for filename in os.listdir(path)
-                   if os.path.splitext(filename)[1].lower() == '.whl'])
+    with os.scandir(path) as entries:
+        return sorted([entry.name for entry in entries
+                       if os.path.splitext(entry.name)[1].lower() == '.whl'])
 
 
 def _open_url(url):
@@ -308,20 +590,25 @@ def _open_url(url):
     return response
 
 
-def _download_file(url, destination):
-    logger.info('Downloading %s to %s...', url, destination)
-
-    response = _open_url(url)
-
-    if not response.code == 200:
+def _open_download(url):
+    try:
+        response = urlopen(url)
+    except urllib.error.HTTPError as ex:
         raise WagonError(
             "Failed to download file. Request to {0} "
-            "failed with HTTP Error: {1}".format(url, response.code))
+            "failed with HTTP Error: {1}".format(url, ex.code))
     final_url = response.geturl()
     if final_url != url and is_verbose():
         logger.debug('Redirected to %s', final_url)
-    f = URLopener()
-    f.retrieve(final_url, destination)
+    return response
+
+
+def _download_file(url, destination):
+    logger.info('Downloading %s to %s...', url, destination)
+
+    with closing(_open_download(url)) as response:
+        with open(destination, 'wb', buffering=DOWNLOAD_BUFFER_SIZE) as f:
+            shutil.copyfileobj(response, f, DOWNLOAD_BUFFER_SIZE)
 
 
 def _http_request(url):
@@ -353,32 +640,227 @@ def _unzip(archive, destination):
         zip_file.extractall(destination)
 
 
-def _tar(source, destination):
+def _get_source_date_epoch():
+    """Return the timestamp to give all archived files.
+
+    This follows the SOURCE_DATE_EPOCH convention
+    (https://reproducible-builds.org/specs/source-date-epoch/) and
+    defaults to 0, so that archiving the same files always produces
+    the same archive.
+    """
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+
+@functools.lru_cache(maxsize=None)
+def _tar_supports_reproducible_archives(tar_path):
+    """Return whether `tar_path` can sort entries and override metadata.
+
+    GNU tar supports this from version 1.28. Other implementations
+    (e.g. bsdtar) don't, in which case `tarfile` is used instead.
+    """
+    result = subprocess.run(
+        [tar_path, '--help'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True)
+    return '--sort=' in result.stdout
+
+
+def _tar(source, destination, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """Create a reproducible tgz archive of `source`.
+
+    Entries are sorted by name and their mtime and ownership are
+    normalized, so the archive only depends on the files' names, modes
+    and contents.
+    """
     logger.info('Creating tgz archive: %s...', destination)
-    with closing(tarfile.open(destination, 'w:gz')) as tar:
-        tar.add(source, arcname=os.path.basename(source))
+    tar_path = None if IS_WIN else which('tar')
+    compressor_path = which('pigz') or which('gzip')
+    mtime = _get_source_date_epoch()
+    if tar_path and compressor_path and \
+            _tar_supports_reproducible_archives(tar_path):
+        _tar_with_executables(
+            tar_path, compressor_path, source, destination, compress_level,
+            mtime)
+    else:
+        def normalize(tarinfo):
+            tarinfo.mtime = mtime
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = ''
+            return tarinfo
+
+        # Without a suitable tar (e.g. on macOS, where tar is bsdtar),
+        # pigz can still compress `tarfile`'s output on all cores.
+        pigz_path = None if IS_WIN else which('pigz')
+        if pigz_path:
+            _tar_with_compressor(
+                pigz_path, source, destination, compress_level, normalize)
+            return
+
+        # Stream mode writes the archive sequentially through a single
+        # compression stream, which is faster for many small files.
+        # `tarfile` adds directory entries sorted by name.
+        with open(destination, 'wb') as archive:
+            with gzip.GzipFile(
+                    filename='', fileobj=archive, mode='wb',
+                    compresslevel=compress_level, mtime=mtime) as compressed:
+                with closing(tarfile.open(
+                        fileobj=compressed, mode='w|')) as tar:
+                    tar.copybufsize = TAR_COPY_BUFFER_SIZE
+                    tar.add(source,
+                            arcname=os.path.basename(source),
+                            filter=normalize)
+
+
+def _tar_with_compressor(compressor_path,
+                         source,
+                         destination,
+                         compress_level=DEFAULT_COMPRESS_LEVEL,
+                         tar_filter=None):
+    """Create a tgz archive with `tarfile`, streaming it into a separate
+    compressor process.
+
+    `tar_filter` is passed on to `TarFile.add`.
+    """
+    compressor_command = [
+        compressor_path, '-c', '-n', '-{0}'.format(compress_level)]
+    if is_verbose():
+        logger.debug('Executing: %r > %s', compressor_command, destination)
+    with open(destination, 'wb') as output:
+        compressor = subprocess.Popen(
+            compressor_command,
+            stdin=subprocess.PIPE,
+            stdout=output,
+            stderr=subprocess.PIPE)
+        stderr_thread = PipeReader(
+            compressor.stderr, compressor, logger, logging.NOTSET)
+        stderr_thread.start()
+        try:
+            with closing(tarfile.open(
+                    fileobj=compressor.stdin, mode='w|')) as tar:
+                tar.copybufsize = TAR_COPY_BUFFER_SIZE
+                tar.add(source,
+                        arcname=os.path.basename(source),
+                        filter=tar_filter)
+        except Exception:
+            compressor.kill()
+            raise
+        finally:
+            compressor.stdin.close()
+            compressor.wait()
+            stderr_thread.join()
+            if not compressor.returncode == 0:
+                os.remove(destination)
+    if not compressor.returncode == 0:
+        raise WagonError(
+            'Failed to create tar archive: {0} (`{1}` returned `{2}`)'.format(
+                destination, compressor_command, stderr_thread.aggr))
+
+
+def _tar_with_executables(tar_path,
+                          compressor_path,
+                          source,
+                          destination,
+                          compress_level=DEFAULT_COMPRESS_LEVEL,
+                          mtime=0):
+    """Create a tgz archive by streaming tar's output into a compressor.
+
+    This is considerably faster than `tarfile` as archiving and
+    compression happen outside of the interpreter and run concurrently.
+    The compressor is pigz if available, so that compression is spread
+    over all cores, or gzip otherwise.
+
+    `tar_path` must be a GNU tar that supports `--sort`.
+    """
+    source = os.path.abspath(source)
+    tar_command = [
+        tar_path, '--format=pax', '--sort=name',
+        # GNU tar stores access and change times in pax headers, and
+        # names the headers after its pid, neither of which is
+        # reproducible.
+        '--pax-option=exthdr.name=%d/PaxHeaders/%f,delete=atime,delete=ctime',
+        '--mtime=@{0}'.format(mtime), '--owner=0', '--group=0',
+        '--numeric-owner', '-C', os.path.dirname(source),
+        '-cf', '-', os.path.basename(source)
+    ]
+    compressor_command = [
+        compressor_path, '-c', '-n', '-{0}'.format(compress_level)]
+    results = _run_pipeline(tar_command, compressor_command, destination)
+    errors = [result.aggr_stderr for result in results
+              if not result.returncode == 0]
+    if errors:
+        os.remove(destination)
+        raise WagonError(
+            'Failed to create tar archive: {0} (`{1}` returned `{2}`)'.format(
+                destination, tar_command, ' '.join(errors)))
 
 
 def _untar(archive, destination):
     logger.debug('Extracting tgz %s to %s...', archive, destination)
-    with closing(tarfile.open(name=archive)) as tar:
-        tar.extractall(path=destination, members=tar.getmembers())
+    # Stream mode reads the archive in a single sequential pass instead of
+    # indexing all members first. It can't seek back though, which
+    # extracting a hardlink requires if linking it to its target fails.
+    try:
+        _extract_tar(archive, destination, 'r|*')
+    except tarfile.StreamError:
+        _extract_tar(archive, destination, 'r:*')
 
 
-def _get_wheel_tags(wheel_name):
-    filename, _ = os.path.splitext(os.path.basename(wheel_name))
-    return filename.split('-')
+def _extract_tar(archive, destination, mode):
+    with closing(tarfile.open(name=archive, mode=mode)) as tar:
+        tar.copybufsize = TAR_COPY_BUFFER_SIZE
+        tar.extractall(path=destination)
+
+
+def _is_tar_url(url):
+    path = urlparse(url).path.lower()
+    return path.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz'))
+
+
+def _download_and_untar(url, destination):
+    """Extract a tar archive while it is being downloaded.
+
+    The response is read as a stream, so the archive is never written
+    to disk before being extracted.
+    """
+    logger.info('Downloading and extracting %s to %s...', url, destination)
+    with closing(_open_download(url)) as response:
+        with closing(tarfile.open(fileobj=response, mode='r|*')) as tar:
+            tar.copybufsize = TAR_COPY_BUFFER_SIZE
+            tar.extractall(path=destination)
 
 
 def _get_platform_from_wheel_name(wheel_name):
     """Extract the platform of a wheel from its file name.
+
+    The platform is always the last dash-separated tag of the name
+    (PEP 427), so there is no need to split the rest of it.
     """
-    return _get_wheel_tags(wheel_name)[-1]
+    filename, _ = os.path.splitext(os.path.basename(wheel_name))
+    return filename.rpartition('-')[2]
 
 
 def _get_platform_for_set_of_wheels(wheels_path):
     """For any set of wheel files, extracts a single platform.
 
+    See `_get_platform_for_wheels` for how the platform is chosen.
+    """
+    return _scan_wheels(wheels_path)[1]
+
+
+def _scan_wheels(wheels_path):
+    """Return the wheels in `wheels_path` along with their platform.
+
+    Lists the directory once and derives the platform from the same
+    listing, so callers needing both don't have to list it twice.
+    """
+    wheels = _get_downloaded_wheels(wheels_path)
+    return wheels, _get_platform_for_wheels(wheels)
+
+
+def _get_platform_for_wheels(wheels):
+    """For a list of wheel file names, extracts a single platform.
+
     Since a set of wheels created or downloaded on one machine can only
     be for a single platform, if any wheel in the set has a platform
     which is not `any`, it will be used with one exception:
@@ -391,9 +873,8 @@ def _get_platform_for_set_of_wheels(wheels_path):
     """
     real_platform = ''
 
-    for wheel in _get_downloaded_wheels(wheels_path):
-        platform = _get_platform_from_wheel_name(
-            os.path.join(wheels_path, wheel))
+    for wheel in wheels:
+        platform = _get_platform_from_wheel_name(wheel)
         if 'linux' in platform and 'manylinux' not in platform:
             # Means either linux_x64_86 or linux_i686 on all wheels
             # If, at any point, a wheel matches this, it will be
@@ -406,6 +887,7 @@ def _get_platform_for_set_of_wheels(wheels_path):
     return real_platform or ALL_PLATFORMS_TAG
 
 
+@functools.lru_cache(maxsize=1)
 def _get_python_version():
     version = sys.version_info
     return 'py{0}{1}'.format(version[0], version[1])
@@ -470,13 +952,23 @@ def _make_virtualenv(virtualenv_dir=None):
 
 
 def _get_package_info_from_pypi(source):
-    pypi_url = DEFAULT_INDEX_SOURCE_URL_TEMPLATE.format(source)
+    return _get_package_info_from_url(
+        DEFAULT_INDEX_SOURCE_URL_TEMPLATE.format(source),
+        int(time.monotonic() // PACKAGE_INFO_CACHE_SECONDS))
+
+
+# `create` looks its source up on PyPI both to resolve it and to name the
+# archive, so responses are kept rather than requested again. `period`
+# only serves to expire them once PACKAGE_INFO_CACHE_SECONDS have passed.
+@functools.lru_cache(maxsize=32)
+def _get_package_info_from_url(pypi_url, period=None):
     if is_verbose():
-        logger.debug('Getting metadata for %s from %s...', source, pypi_url)
+        logger.debug('Getting package metadata from %s...', pypi_url)
     package_data = json.loads(_http_request(pypi_url))
     return package_data['info']
 
 
+@functools.lru_cache(maxsize=1)
 def _get_wagon_version():
     return importlib.metadata.distribution('wagon').version
 
@@ -488,31 +980,139 @@ def _set_python_versions(python_versions=None):
         return [_get_python_version()]
 
 
-def _set_python_requires(wheels_path):
-    python_requires = set()
-    wheels = _get_downloaded_wheels(wheels_path)
+def _get_requires_python(wheel_path):
+    return Wheel(wheel_path).requires_python
+
 
-    for _wheel in wheels:
-        wheel_path = os.path.join(wheels_path, _wheel)
-        package = Wheel(wheel_path)
+def _set_python_requires(wheels_path, wheels=None):
+    if wheels is None:
+        wheels = _get_downloaded_wheels(wheels_path)
+    wheel_paths = [os.path.join(wheels_path, _wheel) for _wheel in wheels]
 
-        if package.requires_python:
-            python_requires.add(package.requires_python)
+    # Reading the metadata means opening each wheel's zip archive, which is
+    # I/O bound, so we read them concurrently.
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        python_requires = set(
+            requires_python for requires_python
+            in executor.map(_get_requires_python, wheel_paths)
+            if requires_python)
 
     return ','.join(python_requires)
 
 
-def _get_name_and_version_from_setup(source_path):
+def _get_name_and_version_from_pkg_info(source_path):
+    if not os.path.isfile(os.path.join(source_path, 'PKG-INFO')):
+        return None
+    package = UnpackedSDist(source_path)
+    if package.name and package.version:
+        return package.name, package.version
+    return None
+
+
+def _is_canonical_version(version):
+    """Return whether `version` is written the way setuptools reports it.
+
+    setuptools normalizes versions (e.g. `1.0.0-beta` becomes `1.0.0b0`),
+    so literals which aren't already normalized can't be used as is.
+    """
+    try:
+        return str(Version(version)) == version
+    except InvalidVersion:
+        return False
+
+
+def _get_setup_keywords(source_path):
+    """Retrieve the keyword arguments passed to `setup()` in setup.py
+    without executing it.
+
+    Each keyword is mapped to its value if that is a string literal, or
+    to None otherwise. None is returned if there is no such call, or if
+    its keywords can't all be told apart (e.g. `setup(**kwargs)`).
+    """
+    with open(os.path.join(source_path, 'setup.py'), 'rb') as setuppy:
+        try:
+            tree = ast.parse(setuppy.read())
+        except SyntaxError:
+            return None
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        function = node.func
+        if getattr(function, 'id', getattr(function, 'attr', '')) != 'setup':
+            continue
+        if any(keyword.arg is None for keyword in node.keywords):
+            return None
+        return {
+            keyword.arg: keyword.value.value
+            if isinstance(keyword.value, ast.Constant)
+            and isinstance(keyword.value.value, str) else None
+            for keyword in node.keywords}
+    return None
+
+
+def _get_name_and_version_from_setup_files(source_path):
+    """Retrieve the name and version from setup.py and setup.cfg the way
+    setuptools does, where the keywords passed to `setup()` take
+    precedence over setup.cfg's metadata.
+    """
+    keywords = _get_setup_keywords(source_path)
+    if keywords is None:
+        return None
+    setup_cfg = configparser.ConfigParser(interpolation=None)
+    setup_cfg.read(os.path.join(source_path, 'setup.cfg'))
+    package_name, package_version = [
+        keywords[field] if field in keywords
+        else setup_cfg.get('metadata', field, fallback=None)
+        for field in ('name', 'version')]
+    # Versions may be declared as e.g. `attr: package.__version__`,
+    # which can only be resolved by setuptools.
+    if package_name and package_version and \
+            _is_canonical_version(package_version):
+        return package_name, package_version
+    return None
 
-    def get_arg(arg_type, setuppy_path):
-        return _run([
-            sys.executable, setuppy_path, '--' + arg_type
-        ]).aggr_stdout.strip()
 
+def _get_name_and_version_from_setup(source_path):
+    """Retrieve the name and version of the package in `source_path`.
+
+    To avoid starting an interpreter just to run setup.py, these are
+    looked up in PKG-INFO, and in the literal arguments passed to
+    `setup()` in setup.py and setup.cfg. Only if those fail is setup.py
+    run.
+    """
     logger.debug('setup.py file found. Retrieving name and version...')
-    setuppy_path = os.path.join(source_path, 'setup.py')
-    package_name = get_arg('name', setuppy_path)
-    package_version = get_arg('version', setuppy_path)
+    name_and_version = \
+        _get_name_and_version_from_pkg_info(source_path) or \
+        _get_name_and_version_from_setup_files(source_path)
+    if name_and_version:
+        return name_and_version
+
+    # Both values are queried in a single run, which prints each of them
+    # on its own line, in the order they were requested.
+    setuppy_command = [
+        sys.executable, os.path.join(source_path, 'setup.py'),
+        '--name', '--version']
+    if is_verbose():
+        logger.debug('Executing: %r', setuppy_command)
+    result = subprocess.run(
+        setuppy_command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    output = [line.strip() for line in result.stdout.splitlines()
+              if line.strip()]
+    if result.returncode != 0 or len(output) < 2:
+        raise WagonError(
+            'Failed to retrieve name and version from setup.py '
+            '(`{0}` returned `{1}`)'.format(
+                ' '.join(setuppy_command), result.stderr.strip()))
+    package_name, package_version = output[-2:]
+    # Older setuptools report versions from setup.cfg as they are written,
+    # while the wheels they build carry the normalized version.
+    try:
+        package_version = str(Version(package_version))
+    except InvalidVersion:
+        pass
     return package_name, package_version
 
 
@@ -633,11 +1233,14 @@ def get_source_name_and_version(source):
     return package_name, package_version
 
 
-def _create_wagon_archive(source_path, archive_path, archive_format='tar.gz'):
+def _create_wagon_archive(source_path,
+                          archive_path,
+                          archive_format='tar.gz',
+                          compress_level=DEFAULT_COMPRESS_LEVEL):
     if archive_format.lower() == 'zip':
         _zip(source_path, archive_path)
     elif archive_format.lower() == 'tar.gz':
-        _tar(source_path, archive_path)
+        _tar(source_path, archive_path, compress_level)
     else:
         raise WagonError(
             'Unsupported archive format to create: {0} '
@@ -665,24 +1268,50 @@ def get_source(source):
                 'Failed to extract {0}. Please verify that the '
                 'provided file is a valid zip or tar.gz '
                 'archive'.format(os.path.basename(source)))
+        return find_source(source, destination)
 
-        source = os.path.join(
-            destination, [d for d in next(os.walk(destination))[1]][0])
-        return source
+    def find_source(source, destination):
+        with os.scandir(destination) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    return entry.path
+        raise WagonError(
+            'Failed to extract {0}. The archive does not contain '
+            'a package directory'.format(os.path.basename(source)))
+
+    def download_and_extract_source(source):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with tempfile.TemporaryDirectory() as download_dir:
+                archive = os.path.join(
+                    download_dir,
+                    os.path.basename(urlparse(source).path) or 'source')
+                _download_file(source, archive)
+                return extract_source(archive, tmpdir)
+        except Exception:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
 
     logger.debug('Retrieving source...')
     if '://' in source:
         split = source.split('://')
         schema = split[0]
-        if schema in ['file', 'http', 'https']:
+        if schema in ['file', 'http', 'https'] and _is_tar_url(source):
             tmpdir = tempfile.mkdtemp()
-            fd, tmpfile = tempfile.mkstemp()
-            os.close(fd)
             try:
-                _download_file(source, tmpfile)
-                source = extract_source(tmpfile, tmpdir)
-            finally:
-                os.remove(tmpfile)
+                _download_and_untar(source, tmpdir)
+                source = find_source(source, tmpdir)
+            except tarfile.TarError:
+                # The URL doesn't serve what its suffix says (e.g. a zip
+                # archive), or can't be extracted in stream mode, so it
+                # is downloaded and its type detected instead.
+                shutil.rmtree(tmpdir, ignore_errors=True)
+                source = download_and_extract_source(source)
+            except Exception:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+                raise
+        elif schema in ['file', 'http', 'https']:
+            source = download_and_extract_source(source)
         else:
             raise WagonError('Source URL type {0} is not supported'.format(
                 schema))
@@ -723,7 +1352,10 @@ def create(source,
            build_tag='',
            pip_paths=None,
            supported_platform=None,
-           add_file=None):
+           add_file=None,
+           compress_level=DEFAULT_COMPRESS_LEVEL,
+           wheel_cache=None,
+           reuse_wheels=False):
     """Create a Wagon archive and returns its path.
 
     Package name and version are extracted from the setup.py file
@@ -738,6 +1370,15 @@ def create(source,
     requirements.txt file or just `.`, in which case requirement files
     will be automatically extracted from either the GitHub archive URL
     or the local path provided provided in `source`.
+
+    `compress_level` is the gzip compression level (1-9) used when
+    `archive_format` is `tar.gz`.
+
+    `wheel_cache` is a directory in which wheels are cached across runs.
+
+    `reuse_wheels` skips downloading wheels if a previous build with the
+    same pinned (PACKAGE_NAME==PACKAGE_VERSION) source, requirement files,
+    wheel args and pip paths already stored them in `wheel_cache`.
     """
     _assert_linux_distribution_exists()
 
@@ -750,107 +1391,141 @@ def create(source,
     package_name, package_version = get_source_name_and_version(
         processed_source)
 
-    tempdir = tempfile.mkdtemp()
+    tempdir = tempfile.mkdtemp(prefix='wagon-')
     workdir = os.path.join(tempdir, package_name)
-    wheels_path = os.path.join(workdir, DEFAULT_WHEELS_PATH)
-    files_path = os.path.join(workdir, DEFAULT_FILES_PATH)
-    files = []
-    pip_paths = pip_paths if pip_paths else [None]
     try:
-        for pip_path in pip_paths:
-            wheels = wheel(
-                processed_source,
-                requirement_files,
-                wheels_path,
-                wheel_args,
-                pip_path)
-    finally:
-        if processed_source != source:
-            shutil.rmtree(processed_source, ignore_errors=True)
-
-    platform = _get_platform_for_set_of_wheels(wheels_path)
-    if supported_platform is not None:
-        platform = supported_platform
-    elif 'manylinux' in platform:
-        # this is a hack to support Cloudify 5.1, who doesn't handle
-        # manylinux wagons. Rename manylinux{1,2010,2014} to linux.
-        # handle new wheel naming convention manylinux*.manylinux*
-        # by getting the last part of platform
-        # example :
-        # >>> arch='manylinux_2_5_x86_64.manylinux1_x86_64'
-        # >>> arch != 'x86_64' and arch.count('_')>0:
-        # ...     arch = arch.partition('_')[2]
-        # >>> arch
-        # 'x86_64'
-        # >>> arch="manylinux_2_5_x86_64"
-        # >>> while arch != 'x86_64' and arch.count('_')>0:
-        # ...     arch = arch.partition('_')[2]
-        # >>> arch
-        # 'x86_64'
-        # >>> arch="manylinux_2_12_i686.manylinux2010_i686"
-        # >>> while arch != 'x86_64' and arch.count('_')>0:
-        # ...     arch = arch.partition('_')[2]
-        # >>> arch
-        # 'i686'
-        arch = platform
-        while arch != 'x86_64' and arch.count('_') > 0:
-            arch = arch.partition('_')[2]
-        platform = 'linux_{0}'.format(arch or 'x86_64')
-
-    if is_verbose():
-        logger.debug('Platform is: %s', platform)
-
-    python_versions = _set_python_versions(python_versions)
-    python_requires = _set_python_requires(wheels_path)
-
-    if not os.path.isdir(archive_destination_dir):
-        os.makedirs(archive_destination_dir)
-    archive_name = _set_archive_name(
-        package_name, package_version, python_versions, platform, build_tag)
-    archive_path = os.path.join(archive_destination_dir, archive_name)
-
-    _handle_output_file(archive_path, force)
-
-    if add_file:
-        for source_path in add_file:
-            if _validate_file_path(source_path):
-                os.makedirs(
-                    files_path,
-                    exist_ok=True,
-                )
-                filename = os.path.basename(source_path)
-                destination_path = os.path.join(
-                    files_path,
-                    filename,
-                )
-                shutil.copy(
-                    source_path,
-                    destination_path,
-                )
-                files.append(
-                    os.path.basename(
+        wheels_path = os.path.join(workdir, DEFAULT_WHEELS_PATH)
+        files_path = os.path.join(workdir, DEFAULT_FILES_PATH)
+        files = []
+        pip_paths = pip_paths if pip_paths else [None]
+        # Files are only hardlinked into the work directory if it is
+        # removed afterwards, so that changes made to a kept work
+        # directory never reach the original files.
+        copy_file = shutil.copy2 if keep_wheels else _link_or_copy
+        fingerprint = reusable_wheels = None
+        # Only pinned PyPI sources are guaranteed not to change between
+        # builds, so other sources are always downloaded.
+        if reuse_wheels and wheel_cache and '==' in processed_source and \
+                not os.path.isdir(processed_source) and \
+                not _has_direct_requirements(requirement_files) and \
+                not _has_direct_requirement_args(wheel_args):
+            fingerprint = _get_wheels_fingerprint(
+                processed_source, requirement_files, wheel_args, pip_paths)
+            reusable_wheels = _get_reusable_wheels(wheel_cache, fingerprint)
+        try:
+            if reusable_wheels:
+                logger.info('Reusing wheels from a previous build...')
+                os.makedirs(wheels_path)
+                for reusable_wheel in reusable_wheels:
+                    copy_file(
+                        os.path.join(wheel_cache, reusable_wheel),
+                        os.path.join(wheels_path, reusable_wheel))
+            else:
+                for pip_path in pip_paths:
+                    wheel(
+                        processed_source,
+                        requirement_files,
+                        wheels_path,
+                        wheel_args,
+                        pip_path,
+                        wheel_cache)
+                if fingerprint:
+                    _save_reusable_wheels(
+                        wheel_cache,
+                        fingerprint,
+                        _get_downloaded_wheels(wheels_path))
+        finally:
+            if processed_source != source:
+                shutil.rmtree(processed_source, ignore_errors=True)
+
+        wheels, platform = _scan_wheels(wheels_path)
+        if supported_platform is not None:
+            platform = supported_platform
+        elif 'manylinux' in platform:
+            # this is a hack to support Cloudify 5.1, who doesn't handle
+            # manylinux wagons. Rename manylinux{1,2010,2014} to linux.
+            # handle new wheel naming convention manylinux*.manylinux*
+            # by getting the last part of platform
+            # example :
+            # >>> arch='manylinux_2_5_x86_64.manylinux1_x86_64'
+            # >>> arch != 'x86_64' and arch.count('_')>0:
+            # ...     arch = arch.partition('_')[2]
+            # >>> arch
+            # 'x86_64'
+            # >>> arch="manylinux_2_5_x86_64"
+            # >>> while arch != 'x86_64' and arch.count('_')>0:
+            # ...     arch = arch.partition('_')[2]
+            # >>> arch
+            # 'x86_64'
+            # >>> arch="manylinux_2_12_i686.manylinux2010_i686"
+            # >>> while arch != 'x86_64' and arch.count('_')>0:
+            # ...     arch = arch.partition('_')[2]
+            # >>> arch
+            # 'i686'
+            arch = platform
+            while arch != 'x86_64' and arch.count('_') > 0:
+                arch = arch.partition('_')[2]
+            platform = 'linux_{0}'.format(arch or 'x86_64')
+
+        if is_verbose():
+            logger.debug('Platform is: %s', platform)
+
+        python_versions = _set_python_versions(python_versions)
+        python_requires = _set_python_requires(wheels_path, wheels)
+
+        if not os.path.isdir(archive_destination_dir):
+            os.makedirs(archive_destination_dir)
+        archive_name = _set_archive_name(
+            package_name, package_version, python_versions, platform,
+            build_tag)
+        archive_path = os.path.join(archive_destination_dir, archive_name)
+
+        _handle_output_file(archive_path, force)
+
+        if add_file:
+            for source_path in add_file:
+                if _validate_file_path(source_path):
+                    os.makedirs(
+                        files_path,
+                        exist_ok=True,
+                    )
+                    filename = os.path.basename(source_path)
+                    destination_path = os.path.join(
+                        files_path,
+                        filename,
+                    )
+                    copy_file(
+                        source_path,
                         destination_path,
                     )
-                )
+                    files.append(
+                        os.path.basename(
+                            destination_path,
+                        )
+                    )
 
-    _generate_metadata_file(
-        workdir,
-        archive_name,
-        platform,
-        python_versions,
-        python_requires,
-        package_name,
-        package_version,
-        build_tag,
-        source,
-        wheels,
-        files,
-    )
+        _generate_metadata_file(
+            workdir,
+            archive_name,
+            platform,
+            python_versions,
+            python_requires,
+            package_name,
+            package_version,
+            build_tag,
+            source,
+            wheels,
+            files,
+        )
 
-    _create_wagon_archive(workdir, archive_path, archive_format)
-    if not keep_wheels:
-        logger.debug('Removing work directory...')
-        shutil.rmtree(tempdir, ignore_errors=True)
+        _create_wagon_archive(
+            workdir, archive_path, archive_format, compress_level)
+    finally:
+        # The work directory is removed even if creation failed, so that
+        # failed runs don't leave their downloaded wheels behind.
+        if not keep_wheels:
+            logger.debug('Removing work directory...')
+            shutil.rmtree(tempdir, ignore_errors=True)
 
     if validate_archive:
         validate(archive_path)
@@ -990,27 +1665,52 @@ def validate(source):
     return validation_errors
 
 
+def _get_archive_metadata(archive):
+    """Read the metadata of a local wagon archive without extracting it.
+
+    Returns None if `archive` isn't a local zip or tar archive containing
+    metadata, in which case it has to go through `get_source`.
+    """
+    def is_metadata(name):
+        parts = name.split('/')
+        return len(parts) == 2 and parts[1] == METADATA_FILE_NAME
+
+    if not os.path.isfile(archive):
+        return None
+    if zipfile.is_zipfile(archive):
+        with closing(zipfile.ZipFile(archive)) as zip_file:
+            for name in zip_file.namelist():
+                if is_metadata(name):
+                    return json.loads(zip_file.read(name).decode('utf-8'))
+    elif tarfile.is_tarfile(archive):
+        with closing(tarfile.open(name=archive, mode='r|*')) as tar:
+            for member in tar:
+                if is_metadata(member.name):
+                    # A hardlinked metadata file can't be read in stream
+                    # mode, so it is left to `get_source` to extract it.
+                    try:
+                        metadata_file = tar.extractfile(member)
+                    except tarfile.StreamError:
+                        return None
+                    return json.loads(metadata_file.read().decode('utf-8'))
+    return None
+
+
 def show(source):
     """Merely returns the metadata for the provided archive.
     """
     if is_verbose():
         logger.info('Retrieving Metadata for: %s', source)
-    processed_source = get_source(source)
-    metadata = _get_metadata(processed_source)
-    shutil.rmtree(processed_source)
+    metadata = _get_archive_metadata(source)
+    if metadata is None:
+        processed_source = get_source(source)
+        metadata = _get_metadata(processed_source)
+        shutil.rmtree(processed_source)
     return metadata
 
 
 def list_files(source):
-    processed_source = get_source(source)
-    metadata = _get_metadata(processed_source)
-
-    shutil.rmtree(
-        processed_source,
-        ignore_errors=True,
-    )
-
-    return metadata['files']
+    return show(source)['files']
 
 
 def get_file(source, filename, output_directory='.'):
@@ -1021,7 +1721,9 @@ def get_file(source, filename, output_directory='.'):
     absolute_destination_path = os.path.abspath(destination_path)
 
     if os.path.isfile(source_path):
-        shutil.copy(
+        # The extracted source is removed right after, so we can move
+        # the file out of it rather than copy it.
+        shutil.move(
             source_path,
             destination_path,
         )
@@ -1147,6 +1849,9 @@ def _create_wagon(args):
             pip_paths=args.pip or [None],
             supported_platform=args.supported_platform,
             add_file=args.add_file,
+            compress_level=args.compress_level,
+            wheel_cache=args.wheel_cache,
+            reuse_wheels=args.reuse_wheels,
         )
     except WagonError as ex:
         sys.exit(ex)
@@ -1268,6 +1973,13 @@ def _add_create_command(parser):
         default='zip',
         choices=(['zip', 'tar.gz']),
         help='Which file format to generate')
+    command.add_argument(
+        '--compress-level',
+        type=int,
+        default=DEFAULT_COMPRESS_LEVEL,
+        choices=range(1, 10),
+        metavar='[1-9]',
+        help='The gzip compression level to use for tar.gz archives')
     command.add_argument(
         '-f',
         '--force',
@@ -1306,6 +2018,19 @@ def _add_create_command(parser):
         help='Allows to pass additional arguments to `pip wheel`. '
              '(e.g. --no-cache-dir -c constains.txt)')
 
+    command.add_argument(
+        '--wheel-cache',
+        default=DEFAULT_WHEEL_CACHE_PATH,
+        help='A directory in which downloaded and built wheels are cached '
+             'across runs. Pass an empty value to disable caching')
+    command.add_argument(
+        '--reuse-wheels',
+        default=False,
+        action='store_true',
+        help='Skip downloading wheels for a pinned PyPI package '
+             '(PACKAGE_NAME==PACKAGE_VERSION) if a previous build with the '
+             'same requirement files and wheel args cached them')
+
     command.add_argument(
         '--pip',
         default=None,
@@ -1498,17 +2223,18 @@ class CustomFormatter(argparse.ArgumentParser):
         sys.exit('\nerror: %s\n' % message)
 
 
-def _assert_atleast_one_arg(parser):
+def _assert_atleast_one_arg(parser, argv):
     """When simply running `wagon`, this will make sure we exit without
     erroring out.
     """
-    if len(sys.argv) == 1:
+    if not argv:
         parser.print_help()
         parser.exit(0)
 
 
-def parse_args():
+def _build_parser():
     parser = CustomFormatter(
+        prog='wagon',
         description=DESCRIPTION,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -1523,13 +2249,21 @@ def parse_args():
     subparsers = _add_list_files_command(subparsers)
     subparsers = _add_get_file_command(subparsers)
 
-    _assert_atleast_one_arg(parser)
+    return parser
+
 
-    return parser.parse_args()
+def parse_args(argv=None):
+    """Parse `argv`, which defaults to the process's arguments.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = _build_parser()
+    _assert_atleast_one_arg(parser, argv)
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
     if args.verbose:
         set_verbose()
     args.func(args)